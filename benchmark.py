@@ -0,0 +1,263 @@
+import argparse
+import contextlib
+import csv
+import io
+import json
+import math
+import random
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+import dorm
+import optimization
+import socialnetwork
+
+
+# Counts the cost evaluations made through costf and records the best cost
+# seen so far against the number of evaluations and the time taken. Offers
+# the same state and batch versions as costf, counting those as well: a
+# delta is one evaluation, a batch one per row.
+class Trace:
+    def __init__(self, costf):
+        self.costf = costf
+        self.evaluations = 0
+        self.best = math.inf
+        # (evaluations, seconds, best cost) every time the best improves
+        self.curve = []
+        self.start = time.perf_counter()
+        if hasattr(costf, 'state'):
+            self.state = self.tracestate
+        if hasattr(costf, 'batch'):
+            self.batch = self.tracebatch
+
+    def record(self, cost, evaluations=1):
+        self.evaluations += evaluations
+        if cost < self.best:
+            self.best = cost
+            self.curve.append((self.evaluations,
+                               time.perf_counter() - self.start, cost))
+
+    def __call__(self, sol):
+        cost = self.costf(sol)
+        self.record(cost)
+        return cost
+
+    def tracebatch(self, pop):
+        costs = np.asarray(self.costf.batch(pop))
+        if len(costs):
+            self.record(costs.min().item(), len(costs))
+        return costs
+
+    def tracestate(self, sol):
+        state = TraceState(self, self.costf.state(sol))
+        self.record(state.cost)
+        return state
+
+
+class TraceState:
+    def __init__(self, trace, state):
+        self.trace = trace
+        self.inner = state
+
+    @property
+    def cost(self):
+        return self.inner.cost
+
+    @property
+    def sol(self):
+        return self.inner.sol
+
+    def delta(self, i, value):
+        delta = self.inner.delta(i, value)
+        self.trace.record(self.inner.cost + delta)
+        return delta
+
+    def apply(self, i, value):
+        self.inner.apply(i, value)
+
+
+# A random group trip for npeople from as many cities, noptions flights
+# each way per person
+def syntheticschedule(npeople, noptions=10, seed=0):
+    rng = random.Random(seed)
+    people = [('Person%d' % i, 'C%d' % i) for i in range(npeople)]
+    flights = {}
+    for _, origin in people:
+        for route in ((origin, 'DST'), ('DST', origin)):
+            for _ in range(noptions):
+                depart = rng.randint(6*60, 20*60 - 1)
+                arrive = depart + rng.randint(60, 4*60)
+                flights.setdefault(route, []).append(
+                    (optimization.clock(depart), optimization.clock(arrive),
+                     rng.randint(50, 500)))
+
+    return optimization.TripProblem(people, 'DST', flights)
+
+
+# A random dorm assignment for nstudents, with a two slot dorm for every
+# two students and a first and second choice each
+def syntheticdorms(nstudents, seed=0):
+    rng = random.Random(seed)
+    dorms = ['Dorm%d' % d for d in range((nstudents + 1) // 2)]
+    students = [('Student%d' % i, tuple(rng.sample(dorms, min(2, len(dorms)))))
+                for i in range(nstudents)]
+
+    return dorm.DormProblem(students, dorms)
+
+
+# A random graph of nnodes nodes and about nlinks links per node to lay out
+def syntheticgraph(nnodes, nlinks=1.5, seed=0):
+    rng = random.Random(seed)
+    ends = []
+    if nnodes > 1:
+        ends = [rng.sample(range(nnodes), 2)
+                for _ in range(round(nnodes * nlinks))]
+
+    return socialnetwork.LayoutProblem(['Node%d' % i for i in range(nnodes)],
+                                       ends)
+
+
+# (name, size, domain, costf) for every problem to run, each at its
+# module's own size and then at every size in sizes, or in graphsizes for
+# the layouts
+def problems(sizes, seed=0, graphsizes=None):
+    if graphsizes is None:
+        graphsizes = sizes
+    yield ('schedule', len(optimization.people),
+           optimization.getproblem().domain, optimization.schedulecost)
+    for size in sizes:
+        problem = syntheticschedule(size, seed=seed)
+        yield 'schedule', size, problem.domain, problem
+    yield 'dorm', len(dorm.prefs), dorm.domain, dorm.dormcost
+    for size in sizes:
+        problem = syntheticdorms(size, seed=seed)
+        yield 'dorm', size, problem.domain, problem
+    yield ('crosscount', len(socialnetwork.people), socialnetwork.domain,
+           socialnetwork.crosscount)
+    for size in graphsizes:
+        problem = syntheticgraph(size, seed=seed)
+        yield 'crosscount', size, problem.domain, problem
+
+
+optimizers = {
+    'random': optimization.randomoptimize,
+    'hillclimb': optimization.hillclimb,
+    'annealing': optimization.annealingoptimize,
+    'genetic': optimization.geneticoptimize,
+    'arraygenetic': optimization.arraygeneticoptimize,
+}
+
+
+# Run one optimizer once. With trace the cost calls are counted, and with
+# memory the peak allocation is measured too, which slows the run down.
+def runone(optimizer, domain, costf, seed, trace=True, memory=False):
+    random.seed(seed)
+    np.random.seed(seed)
+    traced = Trace(costf) if trace else costf
+
+    if memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    # geneticoptimize prints every generation
+    with contextlib.redirect_stdout(io.StringIO()):
+        sol = optimizer(domain, traced)
+    seconds = time.perf_counter() - start
+    peak = None
+    if memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    result = {'seed': seed, 'cost': costf(sol), 'seconds': seconds,
+              'peakmemory': peak, 'evaluations': None, 'evalspersec': None,
+              'curve': None}
+    if trace:
+        result['evaluations'] = traced.evaluations
+        result['evalspersec'] = traced.evaluations / seconds
+        result['curve'] = traced.curve
+    return result
+
+
+# The first point of a best-cost curve at or below target
+def reached(curve, target):
+    for evaluations, seconds, cost in curve or []:
+        if cost <= target:
+            return evaluations, seconds
+    return None, None
+
+
+# Run every optimizer on every problem for every seed. Time to target is
+# measured against the best cost any run found on the problem, allowing
+# a relative gap.
+def benchmark(names=tuple(optimizers), sizes=(50, 200), seeds=3, trace=True,
+              memory=False, gap=0.0, graphsizes=None):
+    results = []
+    for problem, size, domain, costf in problems(sizes,
+                                                 graphsizes=graphsizes):
+        runs = []
+        for name in names:
+            for seed in range(seeds):
+                run = runone(optimizers[name], domain, costf, seed, trace,
+                             memory)
+                run.update(problem=problem, size=size, optimizer=name)
+                runs.append(run)
+
+        target = min(run['cost'] for run in runs) * (1 + gap)
+        for run in runs:
+            run['target'] = target
+            run['evalstotarget'], run['timetotarget'] = reached(run['curve'],
+                                                                target)
+        results.extend(runs)
+
+    return results
+
+
+columns = ['problem', 'size', 'optimizer', 'seed', 'cost', 'seconds',
+           'evaluations', 'evalspersec', 'target', 'evalstotarget',
+           'timetotarget', 'peakmemory']
+
+
+def writecsv(results, out):
+    writer = csv.DictWriter(out, columns, extrasaction='ignore')
+    writer.writeheader()
+    writer.writerows(results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the optimizers')
+    parser.add_argument('--optimizers', nargs='+', default=list(optimizers),
+                        choices=list(optimizers))
+    parser.add_argument('--sizes', nargs='*', type=int, default=[50, 200],
+                        help='people or students in the synthetic problems')
+    # Every step of a hill climber moves a node one pixel, so laying out
+    # graphs takes far longer than the other problems of the same size
+    parser.add_argument('--graph-sizes', nargs='*', type=int,
+                        default=[20, 50],
+                        help='nodes in the synthetic graphs')
+    parser.add_argument('--seeds', type=int, default=3)
+    parser.add_argument('--no-trace', dest='trace', action='store_false',
+                        help='only time the runs, without counting calls')
+    parser.add_argument('--memory', action='store_true',
+                        help='measure peak memory, slows the runs down')
+    parser.add_argument('--gap', type=float, default=0.0,
+                        help='relative gap to the best cost for the target')
+    parser.add_argument('--json', help='write all results, curves included')
+    parser.add_argument('--csv', help='write a summary row per run')
+    args = parser.parse_args()
+
+    results = benchmark(args.optimizers, args.sizes, args.seeds, args.trace,
+                        args.memory, args.gap, args.graph_sizes)
+    if args.json:
+        with open(args.json, 'w') as out:
+            json.dump(results, out, indent=1)
+    if args.csv:
+        with open(args.csv, 'w', newline='') as out:
+            writecsv(results, out)
+    if not args.json and not args.csv:
+        writecsv(results, sys.stdout)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,180 @@
-from collections import defaultdict
+from collections import defaultdict, deque, OrderedDict
+from contextlib import contextmanager
+import hashlib
+from itertools import islice
+import json
 import math
+from multiprocessing import Pool, cpu_count
 import re
+import sqlite3
+import zlib
+
+import numpy as np
+
+
+# Whole runs of 3 to 19 word characters
+WORDS = re.compile(r'\b\w{3,19}\b')
 
 
 def getwords(doc):
-    splitter = re.compile(r'\W+')
-    # Split the words by non-alpha characters
-    words = [s.lower() for s in splitter.split(doc) if len(s)>2 and len(s)<20]
+    # Lowercase once and pick the words out in a single regex pass
+    words = WORDS.findall(doc.lower())
 
     # Return the unique set of words only
-    return {w: 1 for w in words}
+    return dict.fromkeys(words, 1)
+
+
+# The words plus every run of 2 up to n consecutive words
+class NgramFeatures:
+    def __init__(self, n=2):
+        self.n = n
+
+    def __call__(self, doc):
+        words = WORDS.findall(doc.lower())
+        features = dict.fromkeys(words, 1)
+        for k in range(2, self.n+1):
+            for i in range(len(words)-k+1):
+                features[' '.join(words[i:i+k])] = 1
+
+        return features
+
+
+# The hashing trick: maps the features of another function into a fixed
+# number of integer buckets, so the vocabulary never grows past nfeatures
+class HashedFeatures:
+    def __init__(self, getfeatures=getwords, nfeatures=2**20):
+        self.getfeatures = getfeatures
+        self.nfeatures = nfeatures
+
+    def __call__(self, doc):
+        # crc32 rather than hash(), which differs between processes
+        return dict.fromkeys((zlib.crc32(str(f).encode()) % self.nfeatures
+                              for f in self.getfeatures(doc)), 1)
+
+
+# Remembers the features of the last maxsize documents, keyed by a hash of
+# their content. Items other than str or bytes are never cached.
+class FeatureCache:
+    def __init__(self, getfeatures=getwords, maxsize=1024):
+        self.getfeatures = getfeatures
+        self.maxsize = maxsize
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, doc):
+        if isinstance(doc, str):
+            data = doc.encode('utf-8', 'surrogatepass')
+        elif isinstance(doc, bytes):
+            data = doc
+        else:
+            return self.getfeatures(doc)
+
+        key = hashlib.blake2b(data, digest_size=16).digest()
+        features = self.cache.get(key)
+        if features is not None:
+            self.hits += 1
+            self.cache.move_to_end(key)
+            return features
+
+        self.misses += 1
+        features = self.cache[key] = self.getfeatures(doc)
+        # Drop the least recently used document
+        if len(self.cache) > self.maxsize:
+            self.cache.popitem(last=False)
+
+        return features
+
+    # Pickle without the cached documents, e.g. for train_stream workers
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['cache'] = OrderedDict()
+        return state
+
+
+# Sum the table rows selected by each document of a sparse doc x feature
+# matrix given in CSR form (indptr, indices)
+def rowsums(indptr, indices, table):
+    sums = np.zeros((len(indptr)-1, table.shape[1]))
+    nonempty = indptr[1:] > indptr[:-1]
+    if indices.size:
+        sums[nonempty] = np.add.reduceat(table[indices], indptr[:-1][nonempty])
+    return sums
+
+
+# Split an iterable into lists of up to size elements
+def chunked(iterable, size):
+    it = iter(iterable)
+    while True:
+        chunk = list(islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+# Count the features and categories of a chunk of (item, cat) pairs.
+# Runs in the worker processes of train_stream.
+def countchunk(getfeatures, chunk):
+    fcounts = defaultdict(int)
+    ccounts = defaultdict(int)
+    for item, cat in chunk:
+        for f in getfeatures(item):
+            fcounts[f, cat] += 1
+        ccounts[cat] += 1
+
+    return fcounts, ccounts
+
+
+# The nonzero counts of a classifier or store as (feature, cat) -> count
+# and cat -> count dicts, multiplied by sign
+def countdicts(counts, sign=1):
+    cats, vocab, fc, cc = counts.countmatrix()
+    names = sorted(vocab, key=vocab.get)
+
+    rows, cols = fc.nonzero()
+    fcounts = {(names[r], cats[c]): sign*int(fc[r, c])
+               for r, c in zip(rows, cols)}
+    ccounts = {cat: sign*int(n) for cat, n in zip(cats, cc) if n}
+
+    return fcounts, ccounts
+
+
+# Write count dicts to a compact compressed file: the feature and category
+# names as JSON, the counts as coordinate arrays. Names have to be strings
+# or numbers.
+def savecounts(filename, fcounts, ccounts):
+    features = {}
+    cats = {cat: i for i, cat in enumerate(ccounts)}
+    for _, cat in fcounts:
+        cats.setdefault(cat, len(cats))
+    rows = [features.setdefault(f, len(features)) for f, _ in fcounts]
+    cols = [cats[cat] for _, cat in fcounts]
+
+    names = json.dumps([list(features), list(cats)]).encode()
+    with open(filename, 'wb') as out:
+        np.savez_compressed(out,
+                            names=np.frombuffer(names, dtype=np.uint8),
+                            rows=np.array(rows, dtype=np.int64),
+                            cols=np.array(cols, dtype=np.int64),
+                            values=np.array(list(fcounts.values()),
+                                            dtype=np.int64),
+                            catcounts=np.array([ccounts.get(c, 0)
+                                                for c in cats],
+                                               dtype=np.int64))
+
+
+# Read a file written by snapshot into a MemoryCounts store. Merge it into
+# a classifier or use it as the store of a new one.
+def loadsnapshot(filename):
+    with np.load(filename) as data:
+        features, cats = json.loads(data['names'].tobytes())
+        fcounts = {(features[r], cats[c]): int(n) for r, c, n in
+                   zip(data['rows'], data['cols'], data['values'])}
+        ccounts = dict(zip(cats, data['catcounts'].tolist()))
+
+    store = MemoryCounts()
+    store.addcounts(fcounts, ccounts)
+    return store
 
 
 def sampletrain(cl):
@@ -20,46 +185,353 @@ def sampletrain(cl):
     cl.train('the quick brown fox jumps', 'good')
 
 
-class Classifier:
-    def __init__(self, getfeatures=getwords, filename=None):
-        # Counts of feature/category combinations
-        self.fc = defaultdict(lambda: defaultdict(int))
+# Feature and category counts held in memory. Features and categories
+# are interned to row and column numbers of one count matrix, and reading
+# a count never adds anything to the tables.
+class MemoryCounts:
+    def __init__(self):
+        # Feature -> row and category -> column of the count matrix
+        self.features = {}
+        self.catindex = {}
+        # Counts of feature/category combinations, grown as needed
+        self.fc = np.zeros((64, 4), dtype=np.int32)
         # Counts of documents in each category
-        self.cc = defaultdict(int)
+        self.cc = np.zeros(4, dtype=np.int64)
+        # Bumped on every count change so cached tables know to rebuild
+        self.changes = 0
+
+    def featureid(self, f):
+        fid = self.features.get(f)
+        if fid is None:
+            fid = self.features[f] = len(self.features)
+            if fid == self.fc.shape[0]:
+                self.fc = np.pad(self.fc, ((0, fid), (0, 0)))
+        return fid
+
+    def catid(self, cat):
+        cid = self.catindex.get(cat)
+        if cid is None:
+            cid = self.catindex[cat] = len(self.catindex)
+            if cid == self.fc.shape[1]:
+                self.fc = np.pad(self.fc, ((0, 0), (0, cid)))
+                self.cc = np.pad(self.cc, (0, cid))
+        return cid
+
+    def incf(self, f, cat, count=1):
+        fid, cid = self.featureid(f), self.catid(cat)
+        self.fc[fid, cid] += count
+        self.changes += 1
+
+    def incc(self, cat, count=1):
+        cid = self.catid(cat)
+        self.cc[cid] += count
+        self.changes += 1
+
+    # Apply many updates at once. fcounts maps (feature, category) pairs
+    # and ccounts maps categories to the amounts to add.
+    def addcounts(self, fcounts, ccounts):
+        rows = [self.featureid(f) for f, _ in fcounts]
+        cols = [self.catid(cat) for _, cat in fcounts]
+        np.add.at(self.fc, (rows, cols), list(fcounts.values()))
+        for cat, count in ccounts.items():
+            cid = self.catid(cat)
+            self.cc[cid] += count
+        self.changes += 1
+
+    def fcount(self, f, cat):
+        fid = self.features.get(f)
+        cid = self.catindex.get(cat)
+        if fid is None or cid is None:
+            return 0
+        return int(self.fc[fid, cid])
+
+    def catcount(self, cat):
+        cid = self.catindex.get(cat)
+        return 0 if cid is None else int(self.cc[cid])
+
+    def totalcount(self):
+        return int(self.cc.sum())
+
+    def categories(self):
+        return self.catindex.keys()
+
+    def revision(self):
+        return self.changes
+
+    # All the counts as arrays: rows follow the feature ids in vocab,
+    # columns follow cats. vocab is the live feature table, not a copy.
+    def countmatrix(self):
+        nfeatures, ncats = len(self.features), len(self.catindex)
+        counts = self.fc[:nfeatures, :ncats].astype(float)
+        catcounts = self.cc[:ncats].astype(float)
+
+        return list(self.catindex), self.features, counts, catcounts
+
+    # The count rows of just the given features, zero for unknown ones
+    def countrows(self, features):
+        ncats = len(self.catindex)
+        ids = np.array([self.features.get(f, -1) for f in features],
+                       dtype=np.intp)
+        counts = self.fc[np.maximum(ids, 0), :ncats].astype(float)
+        counts[ids < 0] = 0
+
+        return list(self.catindex), counts, self.cc[:ncats].astype(float)
+
+    def sync(self):
+        pass
+
+    def close(self):
+        pass
+
+
+# Feature and category counts kept in an SQLite database, so a trained
+# model survives the process and can be opened by several readers
+class SqliteCounts:
+    def __init__(self, filename):
+        self.con = sqlite3.connect(filename)
+        # Readers keep reading while a writer commits, and a commit only
+        # waits for the disk at checkpoints
+        self.con.execute('pragma journal_mode=wal')
+        self.con.execute('pragma synchronous=normal')
+        self.con.execute('create table if not exists fc(feature, category, '
+                         'count integer, primary key(feature, category)) '
+                         'without rowid')
+        self.con.execute('create table if not exists cc(category primary key, '
+                         'count integer)')
+        self.con.commit()
+        self.changes = 0
+
+    def incf(self, f, cat, count=1):
+        self.addcounts({(f, cat): count}, {})
+
+    def incc(self, cat, count=1):
+        self.addcounts({}, {cat: count})
+
+    # Upsert all the counts with one statement per table, committed
+    # together so they survive the process and other readers see them
+    def addcounts(self, fcounts, ccounts):
+        with self.con:
+            self.con.executemany(
+                'insert into fc values (?, ?, ?) on conflict(feature, '
+                'category) do update set count = count + excluded.count',
+                ((f, cat, count) for (f, cat), count in fcounts.items()))
+            self.con.executemany(
+                'insert into cc values (?, ?) on conflict(category) '
+                'do update set count = count + excluded.count',
+                ccounts.items())
+        self.changes += 1
+
+    def fcount(self, f, cat):
+        res = self.con.execute('select count from fc where feature=? and '
+                               'category=?', (f, cat)).fetchone()
+        return 0 if res is None else res[0]
+
+    def catcount(self, cat):
+        res = self.con.execute('select count from cc where category=?',
+                               (cat,)).fetchone()
+        return 0 if res is None else res[0]
+
+    def totalcount(self):
+        res = self.con.execute('select sum(count) from cc').fetchone()
+        return res[0] or 0
+
+    def categories(self):
+        return [cat for cat, in self.con.execute('select category from cc '
+                                                 'order by category')]
+
+    # data_version moves whenever another connection commits, so readers
+    # pick up a model retrained by another process
+    def revision(self):
+        version, = self.con.execute('pragma data_version').fetchone()
+        return version, self.changes
+
+    # Run the reads inside one read transaction, so they all see the
+    # same commit even while another process retrains. Inside a write
+    # transaction the reads already share one view.
+    @contextmanager
+    def reading(self):
+        if self.con.in_transaction:
+            yield
+            return
+        self.con.execute('begin')
+        try:
+            yield
+        finally:
+            self.con.commit()
+
+    def readcats(self):
+        cats, catcounts = [], []
+        for cat, count in self.con.execute('select category, count from cc '
+                                           'order by category'):
+            cats.append(cat)
+            catcounts.append(count)
+        return cats, np.array(catcounts, dtype=float)
+
+    def countmatrix(self):
+        with self.reading():
+            cats, catcounts = self.readcats()
+            catindex = {c: i for i, c in enumerate(cats)}
+
+            vocab = {}
+            rows, cols, values = [], [], []
+            for f, cat, count in self.con.execute('select * from fc'):
+                rows.append(vocab.setdefault(f, len(vocab)))
+                cols.append(catindex[cat])
+                values.append(count)
+
+        counts = np.zeros((len(vocab), len(cats)))
+        counts[rows, cols] = values
+
+        return cats, vocab, counts, catcounts
+
+    def countrows(self, features, batchsize=500):
+        rowindex = {f: i for i, f in enumerate(features)}
+        with self.reading():
+            cats, catcounts = self.readcats()
+            catindex = {c: i for i, c in enumerate(cats)}
+
+            counts = np.zeros((len(rowindex), len(cats)))
+            # Look the features up a batch at a time
+            for batch in chunked(rowindex, batchsize):
+                query = ('select * from fc where feature in (%s)'
+                         % ','.join('?' * len(batch)))
+                for f, cat, count in self.con.execute(query, batch):
+                    counts[rowindex[f], catindex[cat]] = count
+
+        return cats, counts, catcounts
+
+    # Commit the changes so other processes can see them
+    def sync(self):
+        self.con.commit()
+
+    def close(self):
+        self.con.commit()
+        self.con.close()
+
+
+class Classifier:
+    def __init__(self, getfeatures=getwords, filename=None, store=None):
+        # Where the counts live: in memory unless a database file or
+        # another store is given
+        if store is None and filename is not None:
+            store = SqliteCounts(filename)
+        elif store is None:
+            store = MemoryCounts()
+        self.store = store
+        # Scoring an item against every category asks for its features
+        # once per category, so remember the latest documents
+        if not isinstance(getfeatures, FeatureCache):
+            getfeatures = FeatureCache(getfeatures)
         self.getfeatures = getfeatures
+        self.tables = None
+        self.tablesrevision = None
 
     # Increase the count of a feature/category pair
     def incf(self, f, cat):
-        self.fc[f][cat] += 1
+        self.store.incf(f, cat)
 
     # Increase the count of a category
     def incc(self, cat):
-        self.cc[cat] += 1
+        self.store.incc(cat)
 
     # The number of times a feature has appeared in a category
     def fcount(self, f, cat):
-        return self.fc[f][cat]
+        return self.store.fcount(f, cat)
 
     # The number of times in a category
     def catcount(self, cat):
-        return self.cc[cat]
+        return self.store.catcount(cat)
 
     # The total number of items
     def totalcount(self):
-        return sum(self.cc.values())
+        return self.store.totalcount()
 
     # The list of all categories
     def categories(self):
-        return self.cc.keys()
+        return self.store.categories()
+
+    # Make sure every count change is saved, for stores that buffer them
+    def sync(self):
+        self.store.sync()
+
+    def close(self):
+        self.store.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
     def train(self, item, cat):
         features = self.getfeatures(item)
-        # Increment the count for every feature with this category
-        for f in features:
-            self.incf(f, cat)
-
-        # Increment the count for this category
-        self.incc(cat)
+        # Increment the count for every feature with this category and
+        # the count for this category in a single update
+        self.store.addcounts({(f, cat): 1 for f in features}, {cat: 1})
+
+    # Train from any iterable of (item, cat) pairs, generators included.
+    # Chunks are tokenized in a process pool and each chunk's counts are
+    # applied in one bulk update. getfeatures has to be picklable, i.e. a
+    # module level function, unless processes is 1.
+    def train_stream(self, pairs, chunksize=1000, processes=None):
+        chunks = chunked(pairs, chunksize)
+        if processes == 1:
+            for chunk in chunks:
+                self.store.addcounts(*countchunk(self.getfeatures, chunk))
+        else:
+            processes = processes or cpu_count()
+            with Pool(processes) as pool:
+                # Keep a few chunks per worker in flight so a huge input
+                # is never read into memory all at once
+                pending = deque()
+                for chunk in chunks:
+                    pending.append(pool.apply_async(
+                        countchunk, (self.getfeatures, chunk)))
+                    if len(pending) > 2*processes:
+                        self.store.addcounts(*pending.popleft().get())
+                while pending:
+                    self.store.addcounts(*pending.popleft().get())
+
+        self.store.sync()
+
+    # Take back an earlier train(item, cat), e.g. to correct its label
+    def untrain(self, item, cat):
+        features = self.getfeatures(item)
+        if (self.catcount(cat) < 1 or
+                any(self.fcount(f, cat) < 1 for f in features)):
+            raise ValueError('%r was never trained as %r' % (item, cat))
+
+        self.store.addcounts({(f, cat): -1 for f in features}, {cat: -1})
+
+    # Add the counts of another classifier or store, e.g. one trained on
+    # a different machine or loaded with loadsnapshot
+    def merge(self, other):
+        self.store.addcounts(*countdicts(other))
+
+    # Remove counts that were merged or trained here before
+    def subtract(self, other):
+        fcounts, ccounts = countdicts(other, -1)
+        if (any(self.fcount(f, cat) + n < 0 for (f, cat), n in fcounts.items())
+                or any(self.catcount(c) + n < 0 for c, n in ccounts.items())):
+            raise ValueError('cannot subtract counts that were never added')
+
+        self.store.addcounts(fcounts, ccounts)
+
+    # Save the counts to filename. With a base classifier or store only
+    # the difference from it is saved, which makes a delta for merge.
+    def snapshot(self, filename, base=None):
+        fcounts, ccounts = countdicts(self)
+        if base is not None:
+            basefcounts, baseccounts = countdicts(base, -1)
+            for key, n in basefcounts.items():
+                fcounts[key] = fcounts.get(key, 0) + n
+            for cat, n in baseccounts.items():
+                ccounts[cat] = ccounts.get(cat, 0) + n
+            # Only what changed goes in the delta
+            fcounts = {key: n for key, n in fcounts.items() if n}
+            ccounts = {cat: n for cat, n in ccounts.items() if n}
+
+        savecounts(filename, fcounts, ccounts)
 
     def fprob(self, f, cat):
         if self.catcount(cat) == 0:
@@ -80,12 +552,123 @@ class Classifier:
         # Calculate the weighted average
         return  (weight*ap + totals*basicprob)/(weight+totals)
 
+    def countmatrix(self):
+        return self.store.countmatrix()
+
+    # Start an empty table for the current counts. Rows of log(weighted
+    # probability) from the subclass's loglikrows get filled in by
+    # scoretable as features turn up in the items being scored. Every item
+    # trained changes a category total, and with it the row of every
+    # feature, so new counts start the table over instead of rebuilding
+    # it for the whole vocabulary.
+    def buildtables(self):
+        cats, _, catcounts = self.store.countrows([])
+        self.tables = (cats, catcounts, {}, np.zeros((64, len(cats))))
+
+    # The table with rows for all the known features in featurelists,
+    # computing the missing ones in one pass. Also returns the category
+    # counts the rows were computed from. If another process changed the
+    # counts since the table was started, it starts over from the new ones.
+    def scoretable(self, featurelists):
+        while True:
+            cats, catcounts, vocab, loglik = self.gettables()
+            missing = list({f for features in featurelists for f in features
+                            if f not in vocab})
+            if not missing:
+                return cats, catcounts, vocab, loglik
+
+            rowcats, counts, rowcatcounts = self.store.countrows(missing)
+            if rowcats == cats and np.array_equal(rowcatcounts, catcounts):
+                break
+            self.tablesrevision = None
+
+        known = counts.any(axis=1)
+        counts = counts[known]
+
+        start = len(vocab)
+        for f, isknown in zip(missing, known):
+            if isknown:
+                vocab[f] = len(vocab)
+        if len(vocab) > loglik.shape[0]:
+            loglik = np.pad(loglik, ((0, len(vocab)), (0, 0)))
+            self.tables = (cats, catcounts, vocab, loglik)
+        loglik[start:len(vocab)] = self.loglikrows(counts, catcounts)
+
+        return cats, catcounts, vocab, loglik
+
+    # The scoring tables, started over after any count change
+    def gettables(self):
+        revision = self.store.revision()
+        if self.tablesrevision != revision:
+            self.buildtables()
+            self.tablesrevision = revision
+        return self.tables
+
+    # Turn the features of every item into a sparse doc x feature matrix
+    # over vocab. Also returns the number of features of each item,
+    # including the ones missing from vocab.
+    def featurematrix(self, featurelists, vocab):
+        indptr = [0]
+        indices = []
+        lengths = []
+        for features in featurelists:
+            indices.extend(vocab[f] for f in features if f in vocab)
+            indptr.append(len(indices))
+            lengths.append(len(features))
+
+        return (np.array(indptr, dtype=np.intp),
+                np.array(indices, dtype=np.intp),
+                np.array(lengths, dtype=float))
+
 
 class Naivebayes(Classifier):
-    def __init__(self, getfeatures=getwords):
-        super().__init__(getfeatures)
+    def __init__(self, getfeatures=getwords, filename=None, store=None):
+        super().__init__(getfeatures, filename, store)
         self.thresholds = defaultdict(lambda: 1.0)
 
+    # log(weightedprob) with fprob for rows of feature counts, all at once
+    def loglikrows(self, counts, catcounts, weight=1.0, ap=0.5):
+        # fprob for every pair, 0 for categories without any items
+        fprobs = np.divide(counts, catcounts, out=np.zeros_like(counts),
+                           where=catcounts > 0)
+
+        # Same weighted average as weightedprob, for all pairs at once
+        totals = counts.sum(axis=1, keepdims=True)
+        return np.log((weight*ap + totals*fprobs) / (weight+totals))
+
+    # Log of prob(item, cat) for every item and category, as an
+    # items x cats matrix
+    def logprob_matrix(self, items, ap=0.5):
+        featurelists = [self.getfeatures(item) for item in items]
+        cats, catcounts, vocab, loglik = self.scoretable(featurelists)
+        indptr, indices, lengths = self.featurematrix(featurelists, vocab)
+
+        # Empty categories get a log prior of -inf
+        with np.errstate(divide='ignore', invalid='ignore'):
+            logprior = np.log(catcounts / catcounts.sum())
+
+        # An unseen feature has a weighted probability of exactly ap
+        unknown = lengths - np.diff(indptr)
+        logprobs = (rowsums(indptr, indices, loglik) + logprior
+                    + unknown[:, None]*math.log(ap))
+
+        return cats, logprobs
+
+    def prob_matrix(self, items):
+        cats, logprobs = self.logprob_matrix(items)
+        return cats, np.exp(logprobs)
+
+    # Log of prob(item, cat) for every category, scored in one pass
+    def logprobs(self, item):
+        cats, logprobs = self.logprob_matrix([item])
+        return cats, logprobs[0]
+
+    def logprob(self, item, cat):
+        cats, logprobs = self.logprobs(item)
+        if cat not in cats:
+            return -math.inf
+        return logprobs[cats.index(cat)]
+
     def docprob(self, item, cat):
         features = self.getfeatures(item)
 
@@ -97,10 +680,7 @@ class Naivebayes(Classifier):
         return p
 
     def prob(self, item, cat):
-        catprob = self.catcount(cat) / self.totalcount()
-        docprob = self.docprob(item, cat)
-
-        return docprob * catprob
+        return math.exp(self.logprob(item, cat))
 
     def setthreshold(self, cat, t):
         self.thresholds[cat] = t
@@ -109,29 +689,43 @@ class Naivebayes(Classifier):
         return self.thresholds[cat]
 
     def classify(self, item, default=None):
-        probs = {}
+        # Work with log probabilities, long documents underflow otherwise
+        cats, logprobs = self.logprobs(item)
+        if not cats:
+            return default
 
         # Find the category with the highest probability
-        max = 0.0
-        for cat in self.categories():
-            probs[cat] = self.prob(item, cat)
-            if probs[cat] > max:
-                max = probs[cat]
-                best = cat
+        b = int(logprobs.argmax())
+        best = cats[b]
 
         # Make sure the probability exceeds threshold*next best
-        for cat in probs:
-            if cat == best:
-                continue
-            if probs[cat] * self.getthreshold(best) > probs[best]:
-                return default
+        others = np.delete(logprobs, b)
+        if (others + math.log(self.getthreshold(best)) > logprobs[b]).any():
+            return default
 
         return best
 
+    def classify_many(self, items, default=None):
+        cats, logprobs = self.logprob_matrix(items)
+        if not cats:
+            return [default] * len(logprobs)
+
+        rows = np.arange(len(logprobs))
+        best = logprobs.argmax(axis=1)
+        bestprobs = logprobs[rows, best]
+
+        # The next best category of every item has to stay below
+        # best/threshold
+        logprobs[rows, best] = -math.inf
+        logthresholds = np.log([self.getthreshold(c) for c in cats])
+        passed = logprobs.max(axis=1) + logthresholds[best] <= bestprobs
+
+        return [cats[b] if ok else default for b, ok in zip(best, passed)]
+
 
 class FisherClassifier(Classifier):
-    def __init__(self, getfeatures):
-        super().__init__(getfeatures)
+    def __init__(self, getfeatures, filename=None, store=None):
+        super().__init__(getfeatures, filename, store)
         self.minimums = defaultdict(int)
 
     def setminimum(self, cat, min):
@@ -155,38 +749,100 @@ class FisherClassifier(Classifier):
 
         return p
 
-    def fisherprob(self, item, cat):
-        # Multiply all the probabilities together
-        p = 1
-        features = self.getfeatures(item)
-        for f in features:
-            p *= self.weightedprob(f, cat, self.cprob)
+    # log(weightedprob) with cprob for rows of feature counts, all at once
+    def loglikrows(self, counts, catcounts, weight=1.0, ap=0.5):
+        fprobs = np.divide(counts, catcounts, out=np.zeros_like(counts),
+                           where=catcounts > 0)
 
-        # Take the natural log and multiply by -2
-        fscore = -2 * math.log(p)
+        # Same as cprob: the frequency in this category divided by the
+        # frequency in all the categories
+        freqsums = fprobs.sum(axis=1, keepdims=True)
+        cprobs = np.divide(fprobs, freqsums, out=np.zeros_like(fprobs),
+                           where=fprobs > 0)
 
-        # Use the inverse chi2 function to get a probability
-        return self.invchi2(fscore, len(features)*2)
+        totals = counts.sum(axis=1, keepdims=True)
+        return np.log((weight*ap + totals*cprobs) / (weight+totals))
 
-    def invchi2(self, chi, df):
-        m = chi / 2.0
-        sum = term = math.exp(-m)
-        for i in range(1, df // 2):
-            term *= m/i
-            sum += term
+    # fisherprob for every item and category, as an items x cats matrix
+    def prob_matrix(self, items, ap=0.5):
+        featurelists = [self.getfeatures(item) for item in items]
+        cats, _, vocab, loglik = self.scoretable(featurelists)
+        indptr, indices, lengths = self.featurematrix(featurelists, vocab)
 
-        return min(sum, 1.0)
+        # Add up the logs instead of taking the log of the product, which
+        # underflows to 0 on long documents. Unknown features have a
+        # weighted probability of exactly ap.
+        unknown = lengths - np.diff(indptr)
+        logprods = (rowsums(indptr, indices, loglik)
+                    + unknown[:, None]*math.log(ap))
 
-    def classify(self, item, default=None):
-        # Loop through looking for the best result
-        best = default
-        max = 0
-        for c in self.categories():
-            p = self.fisherprob(item, c)
-            # Make sure it exceeds it's minumum
-            if p > self.getminimum(c) and p > max:
-                best = c
-                max = p
+        fscores = -2 * logprods
+        return cats, invchi2s(fscores, 2 * lengths[:, None])
 
-        return best
+    def fisherprob(self, item, cat):
+        cats, probs = self.prob_matrix([item])
+        if cat in cats:
+            return probs[0, cats.index(cat)]
+
+        # A category without any items, go feature by feature
+        features = self.getfeatures(item)
+        logp = sum(math.log(self.weightedprob(f, cat, self.cprob))
+                   for f in features)
+
+        # Multiply the log by -2 and use the inverse chi2 function to get
+        # a probability
+        return self.invchi2(-2 * logp, len(features)*2)
 
+    def invchi2(self, chi, df):
+        return float(invchi2s(chi, df))
+
+    def classify(self, item, default=None):
+        return self.classify_many([item], default)[0]
+
+    def classify_many(self, items, default=None):
+        cats, probs = self.prob_matrix(items)
+        if not cats:
+            return [default] * len(probs)
+
+        # Only the categories above their minimum take part
+        minimums = np.array([self.getminimum(c) for c in cats])
+        probs = np.where(probs > minimums, probs, 0)
+
+        best = probs.argmax(axis=1)
+        found = probs.max(axis=1) > 0
+
+        return [cats[b] if ok else default for b, ok in zip(best, found)]
+
+
+# invchi2 over arrays of chi values and degrees of freedom. Sums the
+# same series as invchi2, but on the logs of the terms since exp(-chi/2)
+# alone underflows for long documents, and stops each entry as soon as
+# the rest of its series is too small to matter.
+def invchi2s(chi, df, eps=1e-12):
+    chi, df = np.broadcast_arrays(np.asarray(chi, dtype=float),
+                                  np.asarray(df, dtype=int))
+    shape = chi.shape
+    m = chi.ravel() / 2.0
+    nterms = df.ravel() // 2
+    with np.errstate(divide='ignore'):
+        logm = np.log(m)
+
+    logterm = -m
+    logsum = logterm.copy()
+    active = np.flatnonzero(nterms > 1)
+    i = 1
+    while active.size:
+        logterm[active] += logm[active] - math.log(i)
+        logsum[active] = np.logaddexp(logsum[active], logterm[active])
+        i += 1
+
+        # Past i = m every term is at most ratio times the one before, so
+        # the rest of the series adds less than term/(1-ratio)
+        ratio = m[active] / i
+        with np.errstate(divide='ignore', invalid='ignore'):
+            tail = logterm[active] - np.log1p(-ratio)
+        done = (i >= nterms[active]) | ((ratio < 1) &
+                                        (tail < logsum[active] + math.log(eps)))
+        active = active[~done]
+
+    return np.minimum(np.exp(logsum), 1.0).reshape(shape)
@@ -1,3 +1,4 @@
+import numpy as np
 
 
 # the dorms, each of which has two available spaces
@@ -19,44 +20,359 @@ prefs = [('Toby', ('Bacchus', 'Hercules')),
 domain = [(0, len(dorms)*2-i-1) for i in range(len(dorms)*2)]
 
 def printsolution(vec):
-    slots = []
-    # Create two slots for each dorm
-    for i in range(len(dorms)):
-        slots += [i,i]
+    problem.printsolution(vec)
 
-    # Loop over each students assignment
-    for i,x in enumerate(vec):
-        # Choose the slot from the remaining ones
-        dorm = dorms[slots[x]]
-        # Show the student and assigned dorm
-        print(prefs[i][0], dorm)
-        # Remove the slot
-        del slots[x]
+
+# The free slots of the dorms, in order, as a Fenwick tree over 0/1 flags:
+# the k-th free slot is found and taken in O(log n), where del slots[k] on
+# a list is O(n)
+class FreeSlots:
+    def __init__(self, n):
+        self.n = n
+        # Every slot free: node i covers the i & -i slots up to slot i-1
+        self.tree = [i & -i for i in range(n+1)]
+        self.top = 1 << n.bit_length()
+
+    # The number of free slots before slot
+    def rank(self, slot):
+        count = 0
+        while slot > 0:
+            count += self.tree[slot]
+            slot -= slot & -slot
+        return count
+
+    # The k-th free slot, from 0
+    def find(self, k):
+        pos = 0
+        step = self.top
+        while step:
+            if pos+step <= self.n and self.tree[pos+step] <= k:
+                pos += step
+                k -= self.tree[pos]
+            step >>= 1
+        return pos
+
+    # Mark slot taken, or free again with change 1
+    def remove(self, slot, change=-1):
+        i = slot+1
+        while i <= self.n:
+            self.tree[i] += change
+            i += i & -i
+
+    def add(self, slot):
+        self.remove(slot, 1)
+
+    def take(self, k):
+        slot = self.find(k)
+        self.remove(slot)
+        return slot
+
+
+# The dorm of every slot, with capacities[d] slots in dorm d, two each by
+# default
+def slotdorms(capacities=None):
+    if capacities is None:
+        capacities = [2] * len(dorms)
+    return [d for d, capacity in enumerate(capacities)
+            for _ in range(capacity)]
+
+
+# The dorm each student of vec ends up in, in O(n log n)
+def decode(vec, capacities=None):
+    owner = slotdorms(capacities)
+    slots = FreeSlots(len(owner))
+    return [owner[slots.take(x)] for x in vec]
+
+
+# The vec that puts every student in the dorm assignment gives them, the
+# inverse of decode
+def encode(assignment, capacities=None):
+    owner = slotdorms(capacities)
+    # The next unused slot of every dorm
+    first = {}
+    for slot in reversed(range(len(owner))):
+        first[owner[slot]] = slot
+
+    slots = FreeSlots(len(owner))
+    vec = []
+    for d in assignment:
+        slot = first[d]
+        first[d] += 1
+        vec.append(slots.rank(slot))
+        slots.remove(slot)
+    return vec
+
+
+# A dorm assignment problem of any size: students, as (name, (first,
+# second, ...)) pairs with any number of ranked choices, dorms with
+# capacities[d] slots each, two by default. The r-th choice costs
+# rankcosts[r] and a dorm not on the list othercost. Solutions use the
+# same slot-index encoding as dormcost, and the problem is itself the cost
+# function, with batch and state versions, so it plugs into every
+# optimizer in optimization.py:
+#
+#     optimizer(problem.domain, problem)
+class DormProblem:
+    def __init__(self, students, dorms, capacities=None, rankcosts=(0, 1),
+                 othercost=3):
+        self.names = [name for name, _ in students]
+        self.dorms = list(dorms)
+        if capacities is None:
+            capacities = [2] * len(self.dorms)
+        self.capacities = list(capacities)
+        self.owner = slotdorms(self.capacities)
+        nslots = len(self.owner)
+        if len(self.names) > nslots:
+            raise ValueError('more students than slots')
+        self.domain = [(0, nslots-i-1) for i in range(len(self.names))]
+
+        # Every student's choices as dorm indexes, padded with -1, and what
+        # each choice costs them
+        index = {dorm: d for d, dorm in enumerate(self.dorms)}
+        nranks = max([len(choices) for _, choices in students], default=0)
+        self.ranked = np.full((len(self.names), nranks), -1, dtype=np.int32)
+        self.costs = []
+        for i, (_, choices) in enumerate(students):
+            if len(choices) > len(rankcosts):
+                raise ValueError('no cost for choice %d of %s'
+                                 % (len(choices), self.names[i]))
+            costs = {}
+            for r, dorm in enumerate(choices):
+                self.ranked[i, r] = index[dorm]
+                costs.setdefault(index[dorm], rankcosts[r])
+            self.costs.append(costs)
+        self.rankcosts = np.asarray(rankcosts)[:nranks]
+        self.othercost = othercost
+
+    def studentcost(self, student, d):
+        return self.costs[student].get(d, self.othercost)
+
+    def assign(self, vec):
+        return decode(vec, self.capacities)
+
+    def __call__(self, vec):
+        return sum(self.studentcost(i, d)
+                   for i, d in enumerate(self.assign(vec)))
+
+    # The costs of a whole population of solutions, one per row. Every
+    # row is decoded at once, each with a Fenwick tree of free slots as in
+    # FreeSlots, flattened into one array. The trees are padded to twice
+    # the top step with nodes too big to step onto, so the searches and
+    # updates of every row run the same number of steps.
+    def batch(self, pop):
+        pop = np.asarray(pop, dtype=np.int64)
+        npop, nstudents = pop.shape
+        nslots = len(self.owner)
+        owner = np.array(self.owner)
+        top = 1 << nslots.bit_length()
+        width = 2*top
+        nodes = np.arange(nslots+1)
+        trees = np.full((npop, width), nslots+1, dtype=np.int64)
+        trees[:, :nslots+1] = nodes & -nodes
+        trees = trees.ravel()
+        base = np.arange(npop) * width
+        steps = [top >> j for j in range(top.bit_length())]
+
+        assigned = np.empty((npop, nstudents), dtype=np.int64)
+        for i in range(nstudents):
+            k = pop[:, i].copy()
+            pos = np.zeros(npop, dtype=np.int64)
+            for step in steps:
+                value = trees[base + pos + step]
+                move = value <= k
+                pos += step * move
+                k -= value * move
+            assigned[:, i] = owner[pos]
+
+            node = pos + 1
+            for _ in steps:
+                trees[base + node] -= 1
+                node = np.minimum(node + (node & -node), width-1)
+
+        # With no choices listed every student pays othercost
+        if not self.ranked.shape[1]:
+            return np.full(npop, self.othercost * nstudents)
+        match = self.ranked[None, :, :] == assigned[:, :, None]
+        chosen = match.any(axis=2)
+        costs = np.where(chosen, self.rankcosts[match.argmax(axis=2)],
+                         self.othercost)
+        return costs.sum(axis=1)
+
+    def state(self, vec):
+        return DormState(vec, self)
+
+    def printsolution(self, vec):
+        for name, d in zip(self.names, self.assign(vec)):
+            print(name, self.dorms[d])
+
+    # The cheapest assignment of every student, exactly, as a vec. This is
+    # a min-cost flow from the students through the dorms: students are
+    # placed one at a time along the shortest path to a dorm with room,
+    # which may move students already placed from dorm to dorm. Only the
+    # dorms are nodes, with the cheapest move of a student between every
+    # two dorms as the edges, so each placement is a Dijkstra over the
+    # dorms. Moves can cost less than nothing, so every dorm keeps a price
+    # such that a move's cost plus the price of where it starts less the
+    # price of where it ends never is, and the search runs on those
+    # reduced costs. O(n d^2) for n students and d dorms.
+    def solve(self):
+        ndorms = len(self.dorms)
+        nstudents = len(self.names)
+        costs = np.full((nstudents, ndorms), self.othercost, dtype=float)
+        for s, choices in enumerate(self.costs):
+            costs[s, list(choices)] = list(choices.values())
+
+        where = [None] * nstudents
+        members = [set() for d in range(ndorms)]
+        room = np.array(self.capacities)
+        # moves[a, b] is the cheapest move of a student from a to b, and
+        # movers[a, b] the student making it
+        moves = np.full((ndorms, ndorms), np.inf)
+        movers = np.zeros((ndorms, ndorms), dtype=np.intp)
+        # The prices of the dorms, and of leaving through any with room
+        prices = np.zeros(ndorms)
+        exitprice = 0.0
+
+        # Redo the moves out of a
+        def refresh(a):
+            if members[a]:
+                t = np.array(list(members[a]))
+                change = costs[t] - costs[t, a][:, None]
+                best = change.argmin(axis=0)
+                moves[a] = change[best, np.arange(ndorms)]
+                movers[a] = t[best]
+            else:
+                moves[a] = np.inf
+            moves[a, a] = np.inf
+
+        for s in range(nstudents):
+            # Reduced distances from s to every dorm, settled nearest
+            # first, until the way out through a dorm with room is nearer
+            # than any dorm left
+            dist = costs[s] - prices
+            pred = np.full(ndorms, -1)
+            done = np.zeros(ndorms, dtype=bool)
+            exitdist, last = np.inf, None
+            while True:
+                a = np.where(done, np.inf, dist).argmin()
+                if done[a] or dist[a] >= exitdist:
+                    break
+                done[a] = True
+                if room[a] and dist[a] + prices[a] - exitprice < exitdist:
+                    exitdist, last = dist[a] + prices[a] - exitprice, a
+                through = dist[a] + moves[a] + prices[a] - prices
+                better = ~done & (through < dist)
+                dist[better] = through[better]
+                pred[better] = a
+
+            # New prices from the distances, the ones not settled counting
+            # as far as the way out
+            prices += np.where(done, dist, exitdist)
+            exitprice += exitdist
+
+            room[last] -= 1
+            b = last
+            changed = {b}
+            while pred[b] >= 0:
+                a = pred[b]
+                t = movers[a, b]
+                members[a].remove(t)
+                members[b].add(t)
+                where[t] = b
+                changed.add(a)
+                b = a
+            members[b].add(s)
+            where[s] = b
+            for a in changed:
+                refresh(a)
+
+        return encode(where, self.capacities)
+
+
+# A DormProblem read a line at a time from two CSV files without headers:
+# roomsfile holds dorm,capacity lines and prefsfile student,first,second,...
+# lines with any number of choices
+def loadproblem(roomsfile, prefsfile, rankcosts=(0, 1), othercost=3):
+    dorms = []
+    capacities = []
+    with open(roomsfile) as f:
+        for line in f:
+            if line.strip():
+                dorm, capacity = line.strip().split(',')
+                dorms.append(dorm)
+                capacities.append(int(capacity))
+
+    students = []
+    with open(prefsfile) as f:
+        for line in f:
+            if line.strip():
+                name, *choices = line.strip().split(',')
+                students.append((name, tuple(c for c in choices if c)))
+
+    return DormProblem(students, dorms, capacities, rankcosts, othercost)
+
+
+# The problem dormcost solves, the module's students and dorms
+problem = DormProblem(prefs, dorms)
 
 
 def dormcost(vec):
-    slots = []
-    # Create two slots for each dorm
-    for i in range(len(dorms)):
-        slots += [i,i]
-
-    cost = 0
-    # Loop over each student
-    for i,x in enumerate(vec):
-        dorm = dorms[slots[x]]
-        pref = prefs[i][1]
-#        print(prefs[i][0], pref, dorm, end=' ')
-        # First choice costs 0, second choice costs 1, not on the list costs 3
-        if pref[0] == dorm:
-            cost += 0
-#            print()
-        elif pref[1] == dorm:
-            cost += 1
-#            print('+1')
-        else:
-            cost += 3
-#            print('+3')
-
-        del slots[x]
-
-    return cost
+    return problem(vec)
+
+
+# The cheapest assignment of every student, exactly, as a vec for dormcost
+# and printsolution. See DormProblem.solve.
+def solve(prefs=prefs, dorms=dorms, capacities=None):
+    return DormProblem(prefs, dorms, capacities).solve()
+
+
+# A DormProblem's cost kept up to date while one student's choice at a
+# time changes, for the optimizers. Each choice picks from the slots the
+# students before it left over, so a change at student i only re-decodes
+# the students from i on. The state keeps the free slots of the current
+# solution in a FreeSlots, and gives back the slots of students i on to
+# get the slots free at student i, so a change costs O((n-i) log n).
+class DormState:
+    def __init__(self, vec, problem=problem):
+        self.problem = problem
+        self.sol = list(vec)
+        self.slots = FreeSlots(len(problem.owner))
+        # The slot each student ended up in, and what it cost them
+        self.taken = []
+        self.taken, self.costs = self.decode(0, self.sol[0] if self.sol
+                                             else None)
+        self.cost = sum(self.costs)
+
+    # Decode the students from i on, with student i choosing value. Leaves
+    # slots holding the slots free after the new choices.
+    def decode(self, i, value):
+        for slot in self.taken[i:]:
+            self.slots.add(slot)
+        taken = []
+        costs = []
+        for k in range(i, len(self.sol)):
+            slot = self.slots.take(value if k == i else self.sol[k])
+            taken.append(slot)
+            costs.append(self.problem.studentcost(k, self.problem.owner[slot]))
+
+        return taken, costs
+
+    def delta(self, i, value):
+        taken, costs = self.decode(i, value)
+        # Back to the slots of the current solution
+        for slot in taken:
+            self.slots.add(slot)
+        for slot in self.taken[i:]:
+            self.slots.remove(slot)
+        return sum(costs) - sum(self.costs[i:])
+
+    def apply(self, i, value):
+        taken, costs = self.decode(i, value)
+        self.taken[i:] = taken
+        self.costs[i:] = costs
+        self.cost = sum(self.costs)
+        self.sol[i] = value
+
+
+dormcost.state = DormState
+dormcost.batch = problem.batch
@@ -1,8 +1,17 @@
 
+from array import array
+from bisect import bisect_left, insort
+from collections import OrderedDict
 import math
+from multiprocessing import Pool
+import os
+import pickle
+import random as rand
 from random import random, randint
 import time
 
+import numpy as np
+
 people = [('Seymour', 'BOS'),
           ('Franny', 'DAL'),
           ('Zooey', 'CAK'),
@@ -13,12 +22,12 @@ people = [('Seymour', 'BOS'),
 # LaGuardia airport in New York
 destination = 'LGA'
 
-flights = {}
-
-for line in open('schedule.csv'):
-    origin,dest,depart,arrive,price = line.strip().split(',')
-    # Add details to the list of possible flights
-    flights.setdefault((origin,dest), []).append((depart,arrive,int(price)))
+# The flights come from here, loaded the first time they are needed.
+# Call loadschedule to use another file.
+schedulefile = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'schedule.csv')
+currentstore = None
+currentproblem = None
 
 
 def city_name(code):
@@ -41,54 +50,466 @@ def getminutes(t):
     return minutes
 
 
-def printschedule(r):
-    for d in range(len(r) // 2):
-        name = people[d][0]
-        origin = people[d][1]
-        out = flights[(origin,destination)][r[2*d]]
-        ret = flights[(destination,origin)][r[2*d+1]]
-        print('{:>10}{:>10} {:>5}-{:>5} ${:3} {:>5}-{:>5} ${:3}'.format(
-                  name, city_name(origin),
-                  out[0],out[1],out[2],ret[0],ret[1],ret[2]))
+def clock(minutes):
+    return '%d:%02d' % divmod(minutes, 60)
+
+
+# All the flights as columns: origin and destination as ids into codes,
+# departure and arrival in minutes and the price. Indexed by route, with
+# each route's flights in file order, and by departure time within routes.
+class FlightStore:
+    def __init__(self, codes, origin, dest, depart, arrive, price):
+        self.codes = list(codes)
+        self.codeindex = {code: i for i, code in enumerate(self.codes)}
+        self.origin = np.asarray(origin, dtype=np.int32)
+        self.dest = np.asarray(dest, dtype=np.int32)
+        self.depart = np.asarray(depart, dtype=np.int32)
+        self.arrive = np.asarray(arrive, dtype=np.int32)
+        self.price = np.asarray(price, dtype=np.int32)
+
+        # Rows grouped by route, keeping the file order within a route
+        self.order = np.lexsort((self.dest, self.origin))
+        # The same groups, sorted by departure within a route
+        self.timeorder = np.lexsort((self.depart, self.dest, self.origin))
+
+        # (origin, dest) -> where its rows are in order and timeorder
+        self.routes = {}
+        if len(self.order):
+            o, d = self.origin[self.order], self.dest[self.order]
+            starts = np.flatnonzero(np.r_[True, (o[1:] != o[:-1]) |
+                                          (d[1:] != d[:-1])])
+            stops = np.r_[starts[1:], len(self.order)]
+            for start, stop in zip(starts.tolist(), stops.tolist()):
+                route = (self.codes[o[start]], self.codes[d[start]])
+                self.routes[route] = (start, stop)
+
+    # Read a schedule CSV of origin,dest,depart,arrive,price rows. With a
+    # cache file the columns are saved there in binary form and loaded
+    # from it as long as it is newer than the CSV.
+    @classmethod
+    def load(cls, filename, cache=None):
+        if (cache is not None and os.path.exists(cache) and
+                os.path.getmtime(cache) >= os.path.getmtime(filename)):
+            with np.load(cache) as data:
+                return cls(data['codes'].tolist(), data['origin'],
+                           data['dest'], data['depart'], data['arrive'],
+                           data['price'])
+
+        # Read a line at a time into compact columns, handling every
+        # distinct code and time only once
+        codeindex = {}
+        minutes = {}
+        columns = [array('i') for _ in range(5)]
+        with open(filename) as f:
+            for lineno, line in enumerate(f, 1):
+                fields = line.strip().split(',')
+                if fields == ['']:
+                    continue
+                if len(fields) != 5:
+                    raise ValueError('%s:%d: expected 5 fields, got %d'
+                                     % (filename, lineno, len(fields)))
+                origin, dest, depart, arrive, price = fields
+                for t in (depart, arrive):
+                    if t not in minutes:
+                        hours, mins = t.split(':')
+                        minutes[t] = int(hours)*60 + int(mins)
+                columns[0].append(codeindex.setdefault(origin,
+                                                       len(codeindex)))
+                columns[1].append(codeindex.setdefault(dest, len(codeindex)))
+                columns[2].append(minutes[depart])
+                columns[3].append(minutes[arrive])
+                columns[4].append(int(price))
+
+        store = cls(codeindex, *columns)
+        if cache is not None:
+            store.save(cache)
+        return store
+
+    # A store for a {(origin, dest): [(depart, arrive, price), ...]} dict
+    @classmethod
+    def fromdict(cls, flights):
+        codes = {}
+        columns = [], [], [], [], []
+        for (origin, dest), options in flights.items():
+            for depart, arrive, price in options:
+                for column, value in zip(columns, (
+                        codes.setdefault(origin, len(codes)),
+                        codes.setdefault(dest, len(codes)),
+                        getminutes(depart), getminutes(arrive), price)):
+                    column.append(value)
+        return cls(codes, *columns)
+
+    def save(self, cache):
+        with open(cache, 'wb') as f:
+            np.savez(f, codes=np.array(self.codes, dtype=str),
+                     origin=self.origin, dest=self.dest, depart=self.depart,
+                     arrive=self.arrive, price=self.price)
+
+    # The rows of a route in file order
+    def route(self, origin, dest):
+        start, stop = self.routes[(origin, dest)]
+        return self.order[start:stop]
+
+    # The rows of a route departing between start and end minutes, by
+    # departure time
+    def window(self, origin, dest, start, end):
+        first, stop = self.routes[(origin, dest)]
+        rows = self.timeorder[first:stop]
+        departs = self.depart[rows]
+        return rows[np.searchsorted(departs, start, 'left'):
+                    np.searchsorted(departs, end, 'right')]
+
+    def __contains__(self, route):
+        return route in self.routes
+
+    # store[(origin, dest)] gives the same (depart, arrive, price) tuples
+    # the old flights dict had
+    def __getitem__(self, route):
+        rows = self.route(*route)
+        return [(clock(depart), clock(arrive), price) for depart, arrive, price
+                in zip(self.depart[rows].tolist(), self.arrive[rows].tolist(),
+                       self.price[rows].tolist())]
+
+
+def loadschedule(filename=schedulefile, cache=None):
+    global currentstore, currentproblem
+    currentstore = FlightStore.load(filename, cache)
+    currentproblem = None
+    return currentstore
+
+
+def getstore():
+    if currentstore is None:
+        loadschedule()
+    return currentstore
+
+
+# The trip of the module's people and destination
+def getproblem():
+    global currentproblem
+    if currentproblem is None:
+        currentproblem = TripProblem(people, destination, getstore())
+    return currentproblem
+
+
+# optimization.flights and optimization.flighttable still work, loading
+# the schedule on first use
+def __getattr__(name):
+    if name == 'flights':
+        return getstore()
+    if name == 'flighttable':
+        return getproblem().table
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
 
 
-def schedulecost(sol):
-    totalprice = 0
-    latestarrival = 0
-    earliestdep = 24*60
-
-    for d in range(len(sol) // 2):
-        origin = people[d][1]
-        outbound = flights[(origin, destination)][sol[2*d]]
-        returnf  = flights[(destination, origin)][sol[2*d+1]]
+def printschedule(r):
+    getproblem().printschedule(r)
+
+
+# The flights of every person as integer arrays indexed by
+# (person, leg, option), leg 0 being the outbound and leg 1 the return
+# flight. Times are converted to minutes once, here, instead of on every
+# cost evaluation.
+class FlightTable:
+    def __init__(self, people, destination, flights):
+        if not isinstance(flights, FlightStore):
+            flights = FlightStore.fromdict(flights)
+        legs = [(flights.route(origin, destination),
+                 flights.route(destination, origin)) for _, origin in people]
+        noptions = max(len(rows) for person in legs for rows in person)
+        shape = (len(people), 2, noptions)
+
+        self.depart = np.zeros(shape, dtype=np.int64)
+        self.arrive = np.zeros(shape, dtype=np.int64)
+        self.price = np.zeros(shape, dtype=np.int64)
+        for p, person in enumerate(legs):
+            for leg, rows in enumerate(person):
+                self.depart[p, leg, :len(rows)] = flights.depart[rows]
+                self.arrive[p, leg, :len(rows)] = flights.arrive[rows]
+                self.price[p, leg, :len(rows)] = flights.price[rows]
+
+        # Plain lists are faster than arrays for scoring one solution
+        self.lists = (self.depart.tolist(), self.arrive.tolist(),
+                      self.price.tolist())
+
+    # schedulecost of a single solution
+    def cost(self, sol):
+        departs, arrives, prices = self.lists
+        totalprice = 0
+        arrivals = []
+        departures = []
+        for d in range(len(sol) // 2):
+            out, ret = sol[2*d], sol[2*d+1]
+            totalprice += prices[d][0][out] + prices[d][1][ret]
+            arrivals.append(arrives[d][0][out])
+            departures.append(departs[d][1][ret])
+
+        latestarrival = max(arrivals, default=0)
+        earliestdep = min(departures, default=24*60)
+        totalwait = (latestarrival*len(arrivals) - sum(arrivals) +
+                     sum(departures) - earliestdep*len(departures))
+
+        if latestarrival > earliestdep:
+            totalprice += 50
+
+        return totalprice + totalwait
+
+    # schedulecost of every row of a population matrix in one pass
+    def costs(self, pop):
+        pop = np.asarray(pop, dtype=np.intp)
+        persons = np.arange(pop.shape[1] // 2)
+        out = pop[:, 0:2*len(persons):2]
+        ret = pop[:, 1:2*len(persons):2]
 
         # Total price is the price of all outbound and return flights
-        totalprice += outbound[2] + returnf[2]
-
-        # Track the latest arrival and earliest departure
-        if latestarrival < getminutes(outbound[1]):
-            latestarrival = getminutes(outbound[1])
-        if earliestdep > getminutes(returnf[0]):
-            earliestdep = getminutes(returnf[0])
-
-    # Every person must wait at the airport until the latest person arrives.
-    # They also must arrive at the same time and wait for their flights.
-    totalwait = 0
-    for d in range(len(sol) // 2):
-        origin = people[d][1]
-        outbound = flights[(origin, destination)][sol[2*d]]
-        returnf  = flights[(destination, origin)][sol[2*d+1]]
-        
-        totalwait += latestarrival - getminutes(outbound[1])
-        totalwait += getminutes(returnf[0]) - earliestdep
-
-    # Does this solution require an extra day of car rental? That'll be $50!
-    if latestarrival > earliestdep:
-        totalprice += 50
-
-    cost = totalprice + totalwait
-#    print('Totalprice:', totalprice, ', Totalwait:', totalwait, ', Cost:', cost)
-    return cost
+        totalprice = (self.price[persons, 0, out].sum(axis=1) +
+                      self.price[persons, 1, ret].sum(axis=1))
+
+        # Every person must wait at the airport until the latest person
+        # arrives. They also must arrive at the same time and wait for
+        # their flights.
+        arrivals = self.arrive[persons, 0, out]
+        departures = self.depart[persons, 1, ret]
+        latestarrival = arrivals.max(axis=1, initial=0)
+        earliestdep = departures.min(axis=1, initial=24*60)
+        totalwait = ((latestarrival[:, None] - arrivals).sum(axis=1) +
+                     (departures - earliestdep[:, None]).sum(axis=1))
+
+        # Does this solution require an extra day of car rental? That'll
+        # be $50!
+        totalprice += 50 * (latestarrival > earliestdep)
+
+        return totalprice + totalwait
+
+
+# The largest of the sorted values once one x is taken out, None if
+# nothing is left
+def maxwithout(values, x):
+    if values[-1] != x:
+        return values[-1]
+    return values[-2] if len(values) > 1 else None
+
+
+def minwithout(values, x):
+    if values[0] != x:
+        return values[0]
+    return values[1] if len(values) > 1 else None
+
+
+# schedulecost kept up to date while one flight at a time changes.
+# delta(i, value) is the change in cost from setting sol[i] to value and
+# apply(i, value) makes that change. Only the changed flight is looked at:
+# the price and time sums are adjusted, and the latest arrival and the
+# earliest departure come from sorted lists of all of them.
+class ScheduleState:
+    def __init__(self, table, sol):
+        self.table = table
+        self.sol = list(sol)
+        departs, arrives, prices = table.lists
+        n = len(sol) // 2
+
+        self.price = sum(prices[d][0][sol[2*d]] + prices[d][1][sol[2*d+1]]
+                         for d in range(n))
+        self.arrivals = sorted(arrives[d][0][sol[2*d]] for d in range(n))
+        self.departures = sorted(departs[d][1][sol[2*d+1]] for d in range(n))
+        self.sumarr = sum(self.arrivals)
+        self.sumdep = sum(self.departures)
+        self.cost = self.total(self.price, max(self.arrivals, default=0),
+                               min(self.departures, default=24*60),
+                               self.sumarr, self.sumdep)
+
+    def total(self, price, latestarrival, earliestdep, sumarr, sumdep):
+        n = len(self.arrivals)
+        totalwait = latestarrival*n - sumarr + sumdep - earliestdep*n
+        if latestarrival > earliestdep:
+            price += 50
+        return price + totalwait
+
+    # The totals with sol[i] set to value, plus the old and new time of
+    # the flight that changes
+    def change(self, i, value):
+        departs, arrives, prices = self.table.lists
+        d, leg = divmod(i, 2)
+        old = self.sol[i]
+        price = self.price - prices[d][leg][old] + prices[d][leg][value]
+        latestarrival, sumarr = self.arrivals[-1], self.sumarr
+        earliestdep, sumdep = self.departures[0], self.sumdep
+
+        if leg == 0:
+            a, b = arrives[d][0][old], arrives[d][0][value]
+            rest = maxwithout(self.arrivals, a)
+            latestarrival = b if rest is None else max(b, rest)
+            sumarr += b - a
+        else:
+            a, b = departs[d][1][old], departs[d][1][value]
+            rest = minwithout(self.departures, a)
+            earliestdep = b if rest is None else min(b, rest)
+            sumdep += b - a
+
+        return (price, latestarrival, earliestdep, sumarr, sumdep), a, b
+
+    def delta(self, i, value):
+        totals, _, _ = self.change(i, value)
+        return self.total(*totals) - self.cost
+
+    def apply(self, i, value):
+        totals, a, b = self.change(i, value)
+        self.price, _, _, self.sumarr, self.sumdep = totals
+        self.cost = self.total(*totals)
+
+        times = self.arrivals if i % 2 == 0 else self.departures
+        del times[bisect_left(times, a)]
+        insort(times, b)
+        self.sol[i] = value
+
+
+# A group trip: people, as (name, origin) pairs, all flying to destination
+# and back on flights from store. The problem carries its own domain and
+# is itself the cost function, with batch and state versions, so any
+# number of trips can be planned side by side:
+#
+#     optimizer(problem.domain, problem)
+class TripProblem:
+    def __init__(self, people, destination, store):
+        if not isinstance(store, FlightStore):
+            store = FlightStore.fromdict(store)
+        self.people = list(people)
+        self.destination = destination
+        self.table = FlightTable(self.people, destination, store)
+
+        # The options of every outbound and return flight
+        self.domain = []
+        for _, origin in self.people:
+            self.domain.append((0, len(store.route(origin, destination))-1))
+            self.domain.append((0, len(store.route(destination, origin))-1))
+
+    def __call__(self, sol):
+        return self.table.cost(sol)
+
+    def batch(self, pop):
+        return self.table.costs(pop)
+
+    def state(self, sol):
+        return ScheduleState(self.table, sol)
+
+    def printschedule(self, sol):
+        t = self.table
+        for d, (name, origin) in enumerate(self.people):
+            out, ret = sol[2*d], sol[2*d+1]
+            print('{:>10}{:>10} {:>5}-{:>5} ${:3} {:>5}-{:>5} ${:3}'.format(
+                      name, city_name(origin) or origin,
+                      clock(t.depart[d, 0, out]), clock(t.arrive[d, 0, out]),
+                      t.price[d, 0, out], clock(t.depart[d, 1, ret]),
+                      clock(t.arrive[d, 1, ret]), t.price[d, 1, ret]))
+
+
+# Solve many independent TripProblems with one optimizer across a process
+# pool, or in this process if processes is 1. Returns (solution, cost)
+# pairs in the order of problems. Problem i is seeded with seed+i, or
+# randomly without a seed.
+def solvemany(problems, optimizer, processes=None, seed=None, **kwargs):
+    tasks = [(optimizer, problem.domain, problem,
+              None if seed is None else seed+i, kwargs)
+             for i, problem in enumerate(problems)]
+    if processes == 1:
+        runs = [seededrun(*task) for task in tasks]
+    else:
+        with Pool(processes) as pool:
+            runs = pool.starmap(seededrun, tasks)
+    return [(run['solution'], run['cost']) for run in runs]
+
+
+# schedulecost for a whole population of solutions, one per row
+def schedulecosts(pop):
+    return getproblem().table.costs(pop)
+
+
+def schedulecost(sol):
+    return getproblem().table.cost(sol)
+
+# Cost functions may offer a state(sol) for incremental evaluation, see
+# ScheduleState. The optimizers use it when it is there.
+schedulecost.state = lambda sol: ScheduleState(getproblem().table, sol)
+# Likewise a batch(pop) that scores every row of a population matrix
+schedulecost.batch = schedulecosts
+
+
+# Score every row of pop, in one call if costf has a batch version
+def populationcosts(costf, pop):
+    if hasattr(costf, 'batch'):
+        return np.asarray(costf.batch(pop))
+    return np.array([costf(row) for row in pop.tolist()])
+
+
+# Remembers the costs of the last maxsize solutions, for cost functions
+# that are expensive to call: the optimizers score the same solutions
+# again and again. With a filename the costs are loaded from it and save()
+# writes them back, so they carry over to later runs.
+class CostCache:
+    def __init__(self, costf, maxsize=100000, filename=None):
+        self.costf = costf
+        self.maxsize = maxsize
+        self.filename = filename
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if filename is not None and os.path.exists(filename):
+            with open(filename, 'rb') as f:
+                self.cache.update(pickle.load(f))
+
+    def __call__(self, sol):
+        key = tuple(sol)
+        cost = self.cache.get(key)
+        if cost is not None:
+            self.hits += 1
+            self.cache.move_to_end(key)
+            return cost
+
+        self.misses += 1
+        cost = self.cache[key] = self.costf(sol)
+        self.trim()
+        return cost
+
+    # Cached costs for every row of pop. The missing rows are scored
+    # together when costf has a batch version.
+    def batch(self, pop):
+        keys = [tuple(row) for row in np.asarray(pop).tolist()]
+        missing = list(OrderedDict.fromkeys(k for k in keys
+                                            if k not in self.cache))
+        self.misses += len(missing)
+        self.hits += len(keys) - len(missing)
+
+        if missing:
+            costs = populationcosts(self.costf, np.array(missing))
+            self.cache.update(zip(missing, costs.tolist()))
+
+        costs = []
+        for key in keys:
+            self.cache.move_to_end(key)
+            costs.append(self.cache[key])
+        self.trim()
+        return np.array(costs)
+
+    # Drop the least recently used solutions
+    def trim(self):
+        while len(self.cache) > self.maxsize:
+            self.cache.popitem(last=False)
+
+    def hitrate(self):
+        calls = self.hits + self.misses
+        return self.hits / calls if calls else 0.0
+
+    def save(self):
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump(dict(self.cache), f)
+        os.replace(tmp, self.filename)
+
+    # Offer whatever else costf has, e.g. its state
+    def __getattr__(self, name):
+        if name.startswith('__') or name == 'costf':
+            raise AttributeError(name)
+        return getattr(self.costf, name)
 
 
 def randomoptimize(domain, costf=schedulecost):
@@ -114,6 +535,9 @@ def hillclimb(domain, costf=schedulecost):
     # Create a random solution
     sol = random_sched(domain)
 
+    if hasattr(costf, 'state'):
+        return statehillclimb(domain, costf.state(sol))
+
     # Main loop
     while True:
         # Create list of neighboring solutions
@@ -141,9 +565,38 @@ def hillclimb(domain, costf=schedulecost):
     return sol
 
 
+# hillclimb on an incremental cost state: the neighbours are scored by
+# their change in cost instead of from scratch
+def statehillclimb(domain, state):
+    sol = state.sol
+    while True:
+        best = 0
+        move = None
+        for j in range(len(domain)):
+            # One away in each direction
+            for value in (sol[j]-1, sol[j]+1):
+                if domain[j][0] <= value <= domain[j][1]:
+                    delta = state.delta(j, value)
+                    if delta < best:
+                        best = delta
+                        move = (j, value)
+
+        # If there's no improvement, then we've reached the top
+        if move is None:
+            break
+        state.apply(*move)
+
+    return list(sol)
+
+
 def annealingoptimize(domain, costf=schedulecost, T=10000, cool=0.95, step=1):
     # Initialize the values randomly
     vec = random_sched(domain)
+    state = None
+    if hasattr(costf, 'state'):
+        # The state keeps its solution up to date as moves are applied
+        state = costf.state(vec)
+        vec = state.sol
 
     while T>0.1:
         # Choose one of the indices
@@ -154,17 +607,25 @@ def annealingoptimize(domain, costf=schedulecost, T=10000, cool=0.95, step=1):
 
         # Create a new list with one of the values changed
         # Make sure the new value still within the domain[i]
-        vecb = vec[:]
-        vecb[i] = min(max(vecb[i]+dir, domain[i][0]), domain[i][1])
+        value = min(max(vec[i]+dir, domain[i][0]), domain[i][1])
 
         # Calculate the current cost and the new cost
-        ea = costf(vec)
-        eb = costf(vecb)
+        if state is not None:
+            ea = state.cost
+            eb = ea + state.delta(i, value)
+        else:
+            vecb = vec[:]
+            vecb[i] = value
+            ea = costf(vec)
+            eb = costf(vecb)
         p = pow(math.e, (-eb-ea)/T)
 
         # Is it better, or does it make the probability cutoff?
         if eb < ea or random() < p:
-            vec = vecb
+            if state is not None:
+                state.apply(i, value)
+            else:
+                vec = vecb
 
         # Decrease the temperature
         T *= cool
@@ -181,6 +642,8 @@ def geneticoptimize(domain, costf=schedulecost, popsize=50, step=1,
             return vec[0:i] + [vec[i]-step] + vec[i+1:]
         elif vec[i] < domain[i][1]:
             return vec[0:i] + [vec[i]+step] + vec[i+1:]
+        # No room to move, keep it as it is
+        return vec[:]
 
     # Crossover Operation
     def crossover(r1, r2):
@@ -220,3 +683,149 @@ def geneticoptimize(domain, costf=schedulecost, popsize=50, step=1,
     return scores[0][1]
 
 
+# geneticoptimize on a population kept as a 2-D integer array, one
+# solution per row, with selection, crossover and mutation done as array
+# operations for the whole generation.
+#
+# selection is 'elitist' (parents drawn from the elite, as in
+# geneticoptimize) or 'tournament' (the best of tournament random members
+# of the whole population). callback(generation, sol, cost) is called with
+# the best solution of each generation and stops the run by returning
+# True. The run also stops once the best cost has not improved by more
+# than tol for patience generations.
+def arraygeneticoptimize(domain, costf=schedulecost, popsize=50, step=1,
+                         mutprob=0.2, elite=0.2, maxiter=100,
+                         selection='elitist', tournament=3, callback=None,
+                         patience=None, tol=0):
+    if selection not in ('elitist', 'tournament'):
+        raise ValueError('unknown selection %r' % selection)
+
+    # Drawn from the global generator so multistart's seeding applies
+    rng = np.random.default_rng(np.random.randint(2**31))
+    low = np.array([d[0] for d in domain])
+    high = np.array([d[1] for d in domain])
+    n = len(domain)
+
+    # Build the initial population
+    pop = rng.integers(low, high+1, size=(popsize, n))
+    costs = populationcosts(costf, pop)
+
+    # How many winners from each generation?
+    topelite = max(int(elite * popsize), 1)
+    nchildren = popsize - topelite
+    rows = np.arange(nchildren)
+
+    bestcost = math.inf
+    stalled = 0
+    for generation in range(maxiter):
+        order = np.argsort(costs, kind='stable')
+        pop = pop[order]
+        costs = costs[order]
+
+        if callback is not None and callback(generation, pop[0].tolist(),
+                                             costs[0].item()):
+            break
+
+        # Stop when the best cost has converged
+        if costs[0] < bestcost - tol:
+            stalled = 0
+        else:
+            stalled += 1
+            if patience is not None and stalled >= patience:
+                break
+        bestcost = min(bestcost, costs[0])
+
+        if generation == maxiter - 1:
+            break
+
+        # Pick two parents for every child. pop is sorted, so the smallest
+        # index of a tournament is its winner.
+        if selection == 'elitist':
+            parents = rng.integers(0, topelite, size=(nchildren, 2))
+        else:
+            parents = rng.integers(0, popsize,
+                                   size=(nchildren, 2, tournament)).min(axis=2)
+        first = pop[parents[:, 0]]
+        second = pop[parents[:, 1]]
+
+        # Crossover: the start of the first parent, the rest of the second
+        cut = rng.integers(1, max(n-1, 2), size=nchildren)
+        children = np.where(np.arange(n) < cut[:, None], first, second)
+
+        # Mutation: the first parent with one value stepped up or down,
+        # kept within the domain
+        mutants = rng.random(nchildren) < mutprob
+        i = rng.integers(0, n, size=nchildren)
+        moves = np.where(rng.random(nchildren) < 0.5, -step, step)
+        values = np.clip(first[rows, i] + moves, low[i], high[i])
+        children[mutants] = first[mutants]
+        children[mutants, i[mutants]] = values[mutants]
+
+        # The elite carries over with its costs, only children are scored
+        pop = np.concatenate([pop[:topelite], children])
+        costs = np.concatenate([costs[:topelite],
+                                populationcosts(costf, children)])
+
+    return pop[0].tolist()
+
+
+# One run of an optimizer for multistart and solvemany, with the random
+# generators seeded so every run starts somewhere else and can be
+# repeated, or seeded randomly if seed is None
+def seededrun(optimizer, domain, costf, seed, kwargs):
+    rand.seed(seed)
+    np.random.seed(seed)
+
+    start = time.perf_counter()
+    sol = optimizer(domain, costf, **kwargs)
+    return {'seed': seed, 'solution': sol, 'cost': costf(sol),
+            'time': time.perf_counter() - start}
+
+
+# Run any of the optimizers above from runs independent random starts
+# across a process pool. Returns the best solution and the stats of every
+# run; runs that did not finish within timeout seconds are cancelled and
+# have a cost of None. costf has to be picklable, i.e. a module level
+# function. Extra keyword arguments go to the optimizer.
+#
+# With processes=1 the runs go one after another in this process, where a
+# run cannot be stopped part way: timeout only skips the runs that have
+# not started when it is up, so the last run started may finish late.
+def multistart(optimizer, domain, costf=schedulecost, runs=8, processes=None,
+               timeout=None, seed=0, **kwargs):
+    deadline = None if timeout is None else time.monotonic() + timeout
+    seeds = range(seed, seed+runs)
+    stats = []
+
+    if processes == 1:
+        for s in seeds:
+            if deadline is not None and time.monotonic() > deadline:
+                stats.append({'seed': s, 'solution': None, 'cost': None,
+                              'time': None})
+            else:
+                stats.append(seededrun(optimizer, domain, costf, s, kwargs))
+    else:
+        pool = Pool(processes)
+        try:
+            pending = [pool.apply_async(seededrun,
+                                        (optimizer, domain, costf, s, kwargs))
+                       for s in seeds]
+            for s, result in zip(seeds, pending):
+                if deadline is None:
+                    result.wait()
+                else:
+                    result.wait(max(deadline - time.monotonic(), 0))
+                if result.ready():
+                    stats.append(result.get())
+                else:
+                    stats.append({'seed': s, 'solution': None, 'cost': None,
+                                  'time': None})
+        finally:
+            # Stops the runs still going once the budget is used up
+            pool.terminate()
+            pool.join()
+
+    finished = [run for run in stats if run['cost'] is not None]
+    if not finished:
+        return None, stats
+    return min(finished, key=lambda run: run['cost'])['solution'], stats
@@ -1,6 +1,8 @@
+import json
 import math
 from matplotlib.lines import Line2D
 import matplotlib.pyplot as plt
+import numpy as np
 
 people = ['Charlie', 'Augustus', 'Veruca', 
           'Violet', 'Mike', 'Joe', 'Willy', 'Miranda']
@@ -19,44 +21,290 @@ links = [('Augustus', 'Willy'),
 
 domain = [(10,770)] * (len(people)*2)
 
-def crosscount(v):
-    # Convert the number list into a dictionary of person:(x,y)
-    loc = {people[i]: (v[i*2], v[i*2+1]) for i in range(len(people))}
+# Below this many links or nodes every pair is checked, above it only the
+# pairs a grid finds close enough to matter
+gridfrom = 64
+
+
+# Whether the link from p1 to p2 crosses the link from p3 to p4, for many
+# pairs of links at once, each an array of points, one per row. den is 0
+# when the links are parallel, otherwise ua and ub are the fraction of each
+# link where they cross, and they cross when both are between 0 and 1.
+def crossmask(p1, p2, p3, p4):
+    d21, d43, d13 = p2 - p1, p4 - p3, p1 - p3
+    den = d43[:, 1]*d21[:, 0] - d43[:, 0]*d21[:, 1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ua = (d43[:, 0]*d13[:, 1] - d43[:, 1]*d13[:, 0]) / den
+        ub = (d21[:, 0]*d13[:, 1] - d21[:, 1]*d13[:, 0]) / den
+    return (den != 0) & (0 < ua) & (ua < 1) & (0 < ub) & (ub < 1)
+
+
+# The pairs (i, j) of boxes from lo[i] to hi[i] that overlap, each once,
+# in chunks of about chunk pairs. They are found through a uniform grid of
+# cellsize cells: every box goes into the cells it covers, and boxes that
+# share no cell cannot overlap. A pair sharing several cells is kept only
+# in the cell holding the low corner of the overlap.
+def gridpairs(lo, hi, cellsize, chunk=1 << 20):
+    first = np.floor(lo / cellsize).astype(np.int64)
+    last = np.floor(hi / cellsize).astype(np.int64)
+    span = last - first + 1
+    count = span[:, 0] * span[:, 1]
+
+    # One entry per box and cell it covers
+    box = np.repeat(np.arange(len(lo)), count)
+    k = np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count)
+    cx = first[box, 0] + k // span[box, 1]
+    cy = first[box, 1] + k % span[box, 1]
+    order = np.lexsort((cy, cx))
+    box, cx, cy = box[order], cx[order], cy[order]
+
+    # Pair every entry with the entries after it in the same cell
+    starts = np.flatnonzero(np.r_[True, (cx[1:] != cx[:-1]) |
+                                        (cy[1:] != cy[:-1])])
+    ends = np.r_[starts[1:], len(box)]
+    later = np.repeat(ends, ends - starts) - np.arange(len(box)) - 1
+    total = np.cumsum(later)
+    cuts = np.searchsorted(total, np.arange(chunk, total[-1], chunk)) \
+        if len(total) else []
+
+    for s, e in zip(np.r_[0, cuts], np.r_[cuts, len(box)]):
+        n = later[s:e]
+        a = np.repeat(np.arange(s, e), n)
+        b = a + 1 + np.arange(len(a)) - np.repeat(np.cumsum(n) - n, n)
+        i, j = box[a], box[b]
+        corner = np.maximum(lo[i], lo[j])
+        keep = ((corner <= np.minimum(hi[i], hi[j])).all(axis=1)
+                & (np.floor(corner[:, 0] / cellsize) == cx[a])
+                & (np.floor(corner[:, 1] / cellsize) == cy[a]))
+        yield i[keep], j[keep]
+
+
+# The pairs of boxes to test: all of them for a few boxes, the ones that
+# overlap through gridpairs for many
+def testpairs(lo, hi, cellsize):
+    if len(lo) < gridfrom:
+        yield np.triu_indices(len(lo), 1)
+    else:
+        yield from gridpairs(lo, hi, cellsize)
+
+
+# The number of crossing pairs of links, for the nodes at pts, one row per
+# node, and links between the nodes in ends, one (a, b) row per link.
+# Links only cross where their bounding boxes overlap, so on large graphs
+# only those pairs are tested, through a grid with cells about the size of
+# a typical link unless cellsize says otherwise.
+def crossings(pts, ends, cellsize=None):
+    pts = np.asarray(pts, dtype=float)
+    ends = np.asarray(ends, dtype=np.int64).reshape(-1, 2)
+    p1, p2 = pts[ends[:, 0]], pts[ends[:, 1]]
+    lo, hi = np.minimum(p1, p2), np.maximum(p1, p2)
+    if cellsize is None and len(ends):
+        # Not so small that the longest links cover too many cells
+        extent = (hi - lo).max(axis=1)
+        cellsize = max(np.median(extent), extent.max() / 64, 1.0)
 
     total = 0
-    # Loop through every pair of links
-    for i in range(len(links)):
-        for j in range(i+1, len(links)):
-            (x1,y1), (x2,y2) = loc[links[i][0]], loc[links[i][1]]
-            (x3,y3), (x4,y4) = loc[links[j][0]], loc[links[j][1]]
+    for i, j in testpairs(lo, hi, cellsize):
+        total += int(crossmask(p1[i], p2[i], p1[j], p2[j]).sum())
+    return total
+
+
+# The closeness penalty summed over every pair of the nodes at pts, with
+# radius in place of 50 pixels. Nodes closer than radius have overlapping
+# boxes once each is grown into a radius sized box.
+def closenesses(pts, radius=50):
+    pts = np.asarray(pts, dtype=float).reshape(-1, 2)
+    total = 0.0
+    for i, j in testpairs(pts, pts + radius, radius):
+        dist = np.sqrt(((pts[i] - pts[j]) ** 2).sum(axis=1))
+        total += float((1.0 - dist[dist < radius] / radius).sum())
+    return total
+
+
+# A graph to lay out: nodes, a list of names, and the links between them,
+# one (a, b) row of node indexes per link. Solutions are x,y pairs per
+# node within lo and hi, and nodes closer than radius are penalized. The
+# problem is itself the cost function, with a state version that only
+# rescores the node that moves:
+#
+#     optimizer(problem.domain, problem)
+class LayoutProblem:
+    def __init__(self, nodes, ends, lo=10, hi=770, radius=50):
+        self.nodes = list(nodes)
+        self.ends = np.asarray(ends, dtype=np.int64).reshape(-1, 2)
+        self.radius = radius
+        self.domain = [(lo, hi)] * (len(self.nodes)*2)
 
-            den = (y4-y3)*(x2-x1) + (x4-x3)*(y2-y1)
+        # The links touching each node, self links once
+        ids = np.r_[self.ends[:, 0], self.ends[self.ends[:, 0] !=
+                                               self.ends[:, 1], 1]]
+        linkids = np.r_[np.arange(len(self.ends)),
+                        np.flatnonzero(self.ends[:, 0] != self.ends[:, 1])]
+        order = np.argsort(ids, kind='stable')
+        counts = np.bincount(ids, minlength=len(self.nodes))
+        self.nodelinks = np.split(linkids[order], np.cumsum(counts)[:-1])
 
-            # den == 0 fi the lines are parallel
-            if den == 0: 
+    def __call__(self, v):
+        loc = np.asarray(v, dtype=float).reshape(-1, 2)
+        return crossings(loc, self.ends) + closenesses(loc, self.radius)
+
+    def state(self, v):
+        return CrossState(v, self)
+
+    # A starting layout as a solution, from forcelayout
+    def initial(self, iterations=50, seed=None):
+        lo, hi = self.domain[0]
+        return forcelayout(len(self.nodes), self.ends, lo, hi, iterations,
+                           seed)
+
+
+# A LayoutProblem read a line at a time from an edge list: a CSV file of
+# a,b lines, or a JSON lines file of [a, b] lists or {"source": a,
+# "target": b} objects. Fields after the first two of a line, such as a
+# weight, are ignored. Nodes are numbered in the order they first appear.
+def loadgraph(filename, **kwargs):
+    index = {}
+    ends = []
+    jsonlines = filename.endswith(('.jsonl', '.ndjson'))
+    with open(filename) as f:
+        for lineno, line in enumerate(f, 1):
+            if not line.strip():
                 continue
+            if jsonlines:
+                link = json.loads(line)
+                if isinstance(link, dict):
+                    link = link['source'], link['target']
+            else:
+                link = line.strip().split(',')
+            if len(link) < 2:
+                raise ValueError('%s:%d: expected 2 fields, got %d'
+                                 % (filename, lineno, len(link)))
+            for node in link[:2]:
+                ends.append(index.setdefault(str(node), len(index)))
 
-            # Otherwise ua and ub are the fraction of the
-            # line where they cross
-            ua = ((x4-x4)*(y1-y3)-(y4-y3)*(x1-x3))/den
-            ub = ((x2-x1)*(y1-y3)-(y2-y1)*(x1-x3))/den
-
-            # If the fraction is between 0 and 1 for both lines
-            # then they cross each other
-            if 0<ua<1 and 0<ub<1:
-                total += 1
-
-    for i in range(len(people)):
-        for j in range(i+1, len(people)):
-            # Get the locations of the two nodes
-            (x1,y1), (x2,y2) = loc[people[i]], loc[people[j]]
-
-            # Find the distance between them
-            dist = math.sqrt((x1-x2) ** 2 +(y1-y2) ** 2)
-            if dist < 50:
-                total += (1.0-(dist/50))
-    
-    return total
+    return LayoutProblem(list(index), ends, **kwargs)
+
+
+# A force directed layout of nnodes nodes linked by ends, as a solution
+# within lo and hi: linked nodes pull together and all nodes push apart,
+# while the moves allowed shrink every iteration (Fruchterman-Reingold).
+# On large graphs nodes only push on nodes nearer than twice the ideal
+# distance, found through the grid of gridpairs.
+def forcelayout(nnodes, ends, lo=10, hi=770, iterations=50, seed=None):
+    rng = np.random.default_rng(seed)
+    ends = np.asarray(ends, dtype=np.int64).reshape(-1, 2)
+    pos = rng.uniform(lo, hi, (nnodes, 2))
+    # The ideal distance between nodes
+    k = (hi - lo) / math.sqrt(max(nnodes, 1))
+
+    for it in range(iterations):
+        temp = (hi - lo) / 10 * (1 - it / iterations)
+        disp = np.zeros_like(pos)
+        for i, j in testpairs(pos, pos + 2*k, 2*k):
+            diff = pos[i] - pos[j]
+            dist = np.maximum(np.sqrt((diff ** 2).sum(axis=1)), 0.01)
+            push = diff * (k * k / dist ** 2)[:, None]
+            if nnodes >= gridfrom:
+                push[dist > 2*k] = 0
+            for axis in range(2):
+                disp[:, axis] += (np.bincount(i, push[:, axis], nnodes)
+                                  - np.bincount(j, push[:, axis], nnodes))
+
+        a, b = ends[:, 0], ends[:, 1]
+        diff = pos[a] - pos[b]
+        dist = np.maximum(np.sqrt((diff ** 2).sum(axis=1)), 0.01)
+        pull = diff * (dist / k)[:, None]
+
+        for axis in range(2):
+            disp[:, axis] += (np.bincount(b, pull[:, axis], nnodes)
+                              - np.bincount(a, pull[:, axis], nnodes))
+
+        length = np.maximum(np.sqrt((disp ** 2).sum(axis=1)), 1e-9)
+        pos += disp * (np.minimum(length, temp) / length)[:, None]
+        np.clip(pos, lo, hi, out=pos)
+
+    return np.rint(pos).astype(int).ravel().tolist()
+
+
+# The problem crosscount solves, the module's people and links
+problem = LayoutProblem(people,
+                        [(people.index(a), people.index(b)) for a, b in links])
+
+
+def crosscount(v):
+    return problem(v)
+
+
+# A LayoutProblem's cost kept up to date while one coordinate at a time
+# changes, for the optimizers. Moving a node only affects the crossings of
+# its own links and its distances to the other nodes, so only those are
+# redone, each against all the links or nodes at once.
+class CrossState:
+    def __init__(self, v, problem=problem):
+        self.problem = problem
+        self.sol = list(v)
+        self.loc = np.array(v, dtype=float).reshape(-1, 2)
+        self.cost = problem(v)
+
+        # The ends of every link and its bounding box, kept in step with
+        # loc. The boxes are an x row and a y row so each compares quickly.
+        ends = problem.ends
+        self.p1, self.p2 = self.loc[ends[:, 0]], self.loc[ends[:, 1]]
+        self.lo = np.minimum(self.p1, self.p2).T.copy()
+        self.hi = np.maximum(self.p1, self.p2).T.copy()
+        self.ids = np.arange(len(ends))
+
+    # Set coordinate i of the solution to value in loc, redoing only the
+    # links of the node that moves
+    def move(self, i, value):
+        n, axis = divmod(i, 2)
+        self.loc[n, axis] = value
+        mine = self.problem.nodelinks[n]
+        ends = self.problem.ends[mine]
+        self.p1[mine] = self.loc[ends[:, 0]]
+        self.p2[mine] = self.loc[ends[:, 1]]
+        self.lo[:, mine] = np.minimum(self.p1[mine], self.p2[mine]).T
+        self.hi[:, mine] = np.maximum(self.p1[mine], self.p2[mine]).T
+
+    # The part of the cost that involves node n
+    def nodecost(self, n):
+        p1, p2, lo, hi = self.p1, self.p2, self.lo, self.hi
+        total = 0
+
+        mine = self.problem.nodelinks[n]
+        if len(mine):
+            ismine = np.zeros(lo.shape[1], dtype=bool)
+            ismine[mine] = True
+            for i in mine:
+                # Pairs of two of this node's links only count once, and
+                # links whose boxes do not overlap cannot cross
+                j = np.flatnonzero((~ismine | (self.ids > i))
+                                   & (lo[0] <= hi[0, i]) & (lo[1] <= hi[1, i])
+                                   & (hi[0] >= lo[0, i]) & (hi[1] >= lo[1, i]))
+                total += int(crossmask(p1[i:i+1], p2[i:i+1], p1[j],
+                                       p2[j]).sum())
+
+        radius = self.problem.radius
+        dist = np.sqrt(((self.loc - self.loc[n]) ** 2).sum(axis=1))
+        dist[n] = radius
+        return total + float((1.0 - dist[dist < radius] / radius).sum())
+
+    def delta(self, i, value):
+        n = i // 2
+        old = self.loc[n, i % 2]
+        before = self.nodecost(n)
+        self.move(i, value)
+        after = self.nodecost(n)
+        self.move(i, old)
+        return after - before
+
+    def apply(self, i, value):
+        self.cost += self.delta(i, value)
+        self.sol[i] = value
+        self.move(i, value)
+
+
+crosscount.state = CrossState
 
 
 def drawnetwork(sol):
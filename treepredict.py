@@ -1,7 +1,13 @@
 
 from collections import defaultdict, Counter
+import csv
+import json
+from multiprocessing import Pool
+from multiprocessing.shared_memory import SharedMemory
+import os
 from matplotlib.lines import Line2D
 import matplotlib.pyplot as plt
+import numpy as np
 
 
 my_data = [['slashdot',    'USA',         'yes', 18,  'None'],
@@ -23,6 +29,8 @@ my_data = [['slashdot',    'USA',         'yes', 18,  'None'],
 
 
 class DecisionNode:
+    __slots__ = ('col', 'value', 'results', 'tb', 'fb')
+
     def __init__(self, col=-1, value=None, results=None, tb=None, fb=None):
         self.col = col
         self.value = value
@@ -83,41 +91,483 @@ def entropy(rows):
     return ent
 
 
-def buildtree(rows, scoref=entropy):
-    if not rows:
-        return DecisionNode()
-
-    current_score = scoref(rows)
-
-    # Setup some variables to track the best criteria
+# entropy and giniimpurity for many sets of rows at once, given as an
+# array of class counts with one row per set
+def entropycounts(counts):
+    total = np.maximum(counts.sum(axis=1, keepdims=True), 1)
+    p = counts / total
+    with np.errstate(divide='ignore', invalid='ignore'):
+        terms = np.where(counts > 0, p * (np.log(p) / np.log(2)), 0)
+    return -terms.sum(axis=1)
+
+
+def ginicounts(counts):
+    total = np.maximum(counts.sum(axis=1, keepdims=True), 1)
+    p = counts / total
+    return 1 - (p ** 2).sum(axis=1)
+
+
+entropy.counts = entropycounts
+giniimpurity.counts = ginicounts
+
+
+# scoref over class counts, through its counts version when it has one and
+# otherwise on rows rebuilt from the counts, which only hold the result
+def scorecounts(scoref, counts, classes):
+    if hasattr(scoref, 'counts'):
+        return scoref.counts(counts)
+    return np.array([scoref([(c,) for c, n in zip(classes, row)
+                             for _ in range(n)]) for row in counts])
+
+
+# Rows as arrays, one per column: numeric columns as they are, anything
+# else as integer codes into values[col], and the results, the last
+# column, as codes into classes. A numeric column in edges is binned: it
+# holds for every row the bin its value falls in, bin b starting at
+# edges[col][b]. cache is the directory the arrays are mapped from, if
+# any.
+class Dataset:
+    def __init__(self, columns, values, labels, classes, edges=None,
+                 cache=None):
+        self.columns = columns
+        self.values = values
+        self.labels = labels
+        self.classes = classes
+        self.edges = edges or {}
+        self.cache = cache
+
+    @classmethod
+    def fromrows(cls, rows):
+        columns = []
+        values = []
+        for col in range(len(rows[0]) - 1 if rows else 0):
+            column = [row[col] for row in rows]
+            if all(isinstance(v, (int, float)) for v in column):
+                columns.append(np.array(column))
+                values.append(None)
+            else:
+                codes, seen = encode(column)
+                columns.append(codes)
+                values.append(seen)
+
+        labels, classes = encode([row[-1] for row in rows])
+        return cls(columns, values, labels, classes)
+
+    # A Dataset streamed from a CSV file without a header, or a JSON lines
+    # file of lists or objects, chunksize rows at a time, the results last.
+    # A first pass finds the number of rows and the columns whose values
+    # are all numbers, and a second one encodes the rows into arrays. With
+    # cache, a directory, the arrays are written there as .npy files and
+    # memory mapped, and later loads map them again while they are newer
+    # than filename.
+    @classmethod
+    def load(cls, filename, chunksize=100000, cache=None):
+        meta = None if cache is None else os.path.join(cache, 'meta.json')
+        if meta is not None and os.path.exists(meta):
+            if os.path.getmtime(meta) >= os.path.getmtime(filename):
+                return cls.open(cache)
+            os.remove(meta)
+
+        nrows = 0
+        numeric = None
+        integer = None
+        for row in readrows(filename):
+            if numeric is None:
+                numeric = [True] * len(row)
+                integer = [True] * len(row)
+            for col, v in enumerate(row):
+                if numeric[col]:
+                    number = parsenumber(v)
+                    numeric[col] = number is not None
+                    integer[col] &= isinstance(number, int)
+            nrows += 1
+        numeric = numeric or [True]
+
+        def newarray(name, dtype):
+            if cache is None:
+                return np.empty(nrows, dtype=dtype)
+            return np.lib.format.open_memmap(
+                os.path.join(cache, name + '.npy'), mode='w+', dtype=dtype,
+                shape=(nrows,))
+
+        if cache is not None:
+            os.makedirs(cache, exist_ok=True)
+        ncols = len(numeric) - 1
+        columns = []
+        for col in range(ncols):
+            dtype = (np.int32 if not numeric[col] else
+                     np.int64 if integer[col] else np.float64)
+            columns.append(newarray('column%d' % col, dtype))
+        labels = newarray('labels', np.int32)
+        # Every nominal value seen so far with its code, per column
+        indexes = [{} for _ in range(ncols + 1)]
+
+        start = 0
+        for chunk in chunked(readrows(filename), chunksize):
+            end = start + len(chunk)
+            for col in range(ncols + 1):
+                values = [row[col] for row in chunk]
+                if numeric[col]:
+                    values = [parsenumber(v) for v in values]
+                if col == ncols:
+                    index = indexes[col]
+                    labels[start:end] = [index.setdefault(v, len(index))
+                                         for v in values]
+                elif numeric[col]:
+                    columns[col][start:end] = values
+                else:
+                    index = indexes[col]
+                    columns[col][start:end] = [
+                        index.setdefault(v, len(index)) for v in values]
+            start = end
+
+        values = [None if numeric[col] else list(indexes[col])
+                  for col in range(ncols)]
+        data = cls(columns, values, labels, list(indexes[ncols]))
+        if cache is None:
+            return data
+
+        for array in columns + [labels]:
+            array.flush()
+        with open(meta, 'w') as f:
+            json.dump({'values': values, 'classes': data.classes}, f)
+        return cls.open(cache)
+
+    # The Dataset cached in the directory cache by load, memory mapped
+    @classmethod
+    def open(cls, cache):
+        with open(os.path.join(cache, 'meta.json')) as f:
+            meta = json.load(f)
+        columns = [np.load(os.path.join(cache, 'column%d.npy' % col),
+                           mmap_mode='r')
+                   for col in range(len(meta['values']))]
+        labels = np.load(os.path.join(cache, 'labels.npy'), mmap_mode='r')
+        return cls(columns, meta['values'], labels, meta['classes'],
+                   cache=cache)
+
+    # The same rows with every numeric column of more than maxbins values
+    # binned, into bins holding about as many rows each. bestsplit then
+    # splits these columns between bins from one histogram of bins by
+    # class, without sorting.
+    def binned(self, maxbins=256):
+        columns = list(self.columns)
+        edges = dict(self.edges)
+        for col, column in enumerate(self.columns):
+            if not self.isnumeric(col) or col in edges:
+                continue
+            values = np.sort(column)
+            if np.count_nonzero(values[1:] != values[:-1]) < maxbins:
+                continue
+            bounds = np.unique(values[np.linspace(
+                0, len(values) - 1, maxbins).astype(np.int64)])
+            edges[col] = bounds
+            columns[col] = (np.searchsorted(bounds, column, side='right')
+                            - 1).astype(np.int16 if maxbins < 2**15
+                                        else np.int32)
+        return Dataset(columns, self.values, self.labels, self.classes, edges)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def isnumeric(self, col):
+        return self.values[col] is None
+
+    # The rows, all of them by default, sorted by every numeric column,
+    # once for the tree
+    def presort(self, rows=None):
+        sort = [col for col in range(len(self.columns))
+                if self.isnumeric(col) and col not in self.edges]
+        if rows is None:
+            return {col: np.argsort(self.columns[col], kind='stable')
+                    for col in sort}
+        return {col: rows[np.argsort(self.columns[col][rows], kind='stable')]
+                for col in sort}
+
+    def classcounts(self, rows):
+        return np.bincount(self.labels[rows], minlength=len(self.classes))
+
+
+# The rows of a CSV or JSON lines file, as lists
+def readrows(filename):
+    with open(filename, newline='') as f:
+        if filename.endswith(('.jsonl', '.ndjson')):
+            for line in f:
+                if line.strip():
+                    row = json.loads(line)
+                    yield list(row.values()) if isinstance(row, dict) else row
+        else:
+            for row in csv.reader(f):
+                if row:
+                    yield row
+
+
+# The number v is or holds, an int where it can be, or None
+def parsenumber(v):
+    if isinstance(v, (int, float)) and not isinstance(v, bool):
+        return v
+    if not isinstance(v, str):
+        return None
+    try:
+        return int(v)
+    except ValueError:
+        pass
+    try:
+        return float(v)
+    except ValueError:
+        return None
+
+
+# Lists of up to size items of iterable at a time
+def chunked(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+# Integer codes for values, in order of appearance, and the values
+def encode(values):
+    index = {}
+    codes = np.array([index.setdefault(v, len(index)) for v in values],
+                     dtype=np.int64)
+    return codes, list(index)
+
+
+# The best split of rows, an array of row indexes into data, as (gain,
+# col, value, truemask), or None when nothing gains. orders holds the rows
+# sorted by every numeric column, and only the columns in cols are tried,
+# all of them by default. A numeric column is swept once in sorted
+# order with cumulative class counts, splitting between every two distinct
+# values, and a nominal column takes the class counts of each value from
+# one histogram.
+def bestsplit(data, rows, orders, scoref, cols=None):
+    nclasses = len(data.classes)
+    total = data.classcounts(rows)
+    n = len(rows)
+    current = scorecounts(scoref, total[None, :], data.classes)[0]
+
+    best = None
     best_gain = 0
-    best_criteria = None
-    best_sets = None
-
-    for col in range(len(rows[0]) - 1):
-        # Generate the list of different values in this column
-        column_values = set(row[col] for row in rows)
-
-        # Now try dividing the rows up for each value in this column
-        for value in column_values:
-            (set1, set2) = divideset(rows, col, value)
-
-            # Information gain
-            p = len(set1) / len(rows)
-            gain = current_score - p*scoref(set1) - (1-p)*scoref(set2)
-            if gain > best_gain and set1 and set2:
-                best_gain = gain
-                best_criteria = (col, value)
-                best_sets = (set1, set2)
-
-    # Create the subbranches
-    if best_gain > 0:
-        trueBranch = buildtree(best_sets[0])
-        falseBranch = buildtree(best_sets[1])
-        return DecisionNode(col=best_criteria[0], value=best_criteria[1],
-                            tb=trueBranch, fb=falseBranch)
-    else:
-        return DecisionNode(results=uniquecounts(rows))
+    for col in range(len(data.columns)) if cols is None else cols:
+        column = data.columns[col]
+        if col in data.edges:
+            codes = column[rows]
+            nbins = len(data.edges[col])
+            hist = np.bincount(codes * nclasses + data.labels[rows],
+                               minlength=nbins * nclasses)
+            below = np.cumsum(hist.reshape(nbins, nclasses), axis=0)
+            sizes = below.sum(axis=1)[:-1]
+            # Split before every bin with rows both below and from it on
+            at = np.flatnonzero((sizes > 0) & (sizes < n)) + 1
+            false = below[at-1]
+        elif data.isnumeric(col):
+            order = orders[col]
+            values = column[order]
+            onehot = np.zeros((n, nclasses), dtype=np.int64)
+            onehot[np.arange(n), data.labels[order]] = 1
+            below = np.cumsum(onehot, axis=0)
+            # Split before every row whose value differs from the last
+            at = np.flatnonzero(values[1:] != values[:-1]) + 1
+            false = below[at-1]
+        else:
+            codes = column[rows]
+            hist = np.bincount(codes * nclasses + data.labels[rows],
+                               minlength=len(data.values[col]) * nclasses)
+            hist = hist.reshape(-1, nclasses)
+            sizes = hist.sum(axis=1)
+            at = np.flatnonzero((sizes > 0) & (sizes < n))
+            false = total - hist[at]
+        if not len(at):
+            continue
+
+        true = total - false
+        p = true.sum(axis=1) / n
+        gains = (current - p * scorecounts(scoref, true, data.classes)
+                 - (1-p) * scorecounts(scoref, false, data.classes))
+        i = gains.argmax()
+        # Gains that are only rounding do not count
+        if gains[i] > best_gain + 1e-12:
+            best_gain = gains[i]
+            if col in data.edges:
+                best = (col, data.edges[col][at[i]].item(), codes >= at[i])
+            elif data.isnumeric(col):
+                threshold = values[at[i]]
+                best = (col, threshold.item(), column[rows] >= threshold)
+            else:
+                best = (col, data.values[col][at[i]], codes == at[i])
+
+    return None if best is None else (best_gain,) + best
+
+
+# The results of a leaf over rows, as uniquecounts
+def leafresults(data, rows):
+    counts = data.classcounts(rows)
+    return Counter({data.classes[c]: int(n) for c, n in enumerate(counts)
+                    if n})
+
+
+# rows can be a list of rows, as my_data, or a Dataset. The best split of
+# every node is found through bestsplit from index arrays into the data,
+# with the numeric columns sorted once for the whole tree. Nodes deeper
+# than maxdepth or with fewer than minsamples rows are not split.
+def buildtree(rows, scoref=entropy, maxdepth=None, minsamples=2):
+    data = rows if isinstance(rows, Dataset) else Dataset.fromrows(rows)
+    if not len(data):
+        return DecisionNode()
+    return growtree(data, np.arange(len(data)), scoref, maxdepth, minsamples)
+
+
+# The tree of buildtree over rows, an array of row indexes into data that
+# may repeat rows. With features, every node only tries that many of the
+# columns, picked at random by rng.
+#
+# The tree is grown from a stack of nodes to split rather than by
+# recursion, so deep trees do not run out of stack. Every node's rows are
+# a slice of one array of row indexes, and of every sorted order, which a
+# split partitions in place into the rows of its true and false branches.
+def growtree(data, rows, scoref=entropy, maxdepth=None, minsamples=2,
+             features=None, rng=None):
+    rows = np.array(rows)
+    orders = data.presort(rows)
+    # Which of the rows being split go to the true branch
+    side = np.zeros(len(data), dtype=bool)
+    cols = None
+
+    tree = DecisionNode()
+    # The nodes to grow, with their rows, rows[start:end], and depth
+    stack = [(tree, 0, len(rows), 0)]
+    while stack:
+        node, start, end, depth = stack.pop()
+        split = None
+        if end - start >= minsamples and (maxdepth is None or
+                                          depth < maxdepth):
+            if features is not None:
+                cols = np.sort(rng.choice(len(data.columns), features,
+                                          replace=False))
+            split = bestsplit(data, rows[start:end],
+                              {col: order[start:end]
+                               for col, order in orders.items()}, scoref,
+                              cols)
+        if split is None:
+            node.results = leafresults(data, rows[start:end])
+            continue
+
+        _, node.col, node.value, truemask = split
+        side[rows[start:end]] = truemask
+        for order in [rows, *orders.values()]:
+            part = order[start:end]
+            true = side[part]
+            part[:] = np.concatenate((part[true], part[~true]))
+
+        middle = start + int(truemask.sum())
+        node.tb = DecisionNode()
+        node.fb = DecisionNode()
+        stack.append((node.fb, middle, end, depth+1))
+        stack.append((node.tb, start, middle, depth+1))
+
+    return tree
+
+
+# A random forest: trees grown on bootstrap samples of the rows, trying a
+# random subset of the columns at every node
+class Forest:
+    def __init__(self, trees):
+        self.trees = trees
+
+    # The leaves the observation reaches, one per tree, each scaled to sum
+    # to 1 and added up, so every tree has the same say
+    def classify(self, observation):
+        votes = Counter()
+        for tree in self.trees:
+            results = classify(observation, tree)
+            total = sum(results.values())
+            for result, count in results.items():
+                votes[result] += count / total
+        return votes
+
+
+# A Dataset's arrays copied into shared memory once, so that the workers
+# of a pool read them in place instead of each getting a pickled copy.
+# spec is what attach needs to rebuild the Dataset in a worker.
+class SharedDataset:
+    def __init__(self, data):
+        self.blocks = []
+        arrays = []
+        for array in data.columns + [data.labels]:
+            block = SharedMemory(create=True, size=max(array.nbytes, 1))
+            np.ndarray(array.shape, array.dtype, block.buf)[:] = array
+            self.blocks.append(block)
+            arrays.append((block.name, array.shape, array.dtype.str))
+        self.spec = (arrays, data.values, data.classes, data.edges)
+
+    def close(self):
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+
+
+# The Dataset shared with this worker and the blocks it lives in
+workerdata = None
+workerblocks = []
+
+
+# spec is a SharedDataset's, or the cache directory of a Dataset, which
+# the workers map themselves
+def attach(spec):
+    global workerdata
+    if isinstance(spec, str):
+        workerdata = Dataset.open(spec)
+        return
+
+    arrays, values, classes, edges = spec
+    columns = []
+    for name, shape, dtype in arrays:
+        block = SharedMemory(name=name)
+        workerblocks.append(block)
+        columns.append(np.ndarray(shape, dtype, block.buf))
+    workerdata = Dataset(columns[:-1], values, columns[-1], classes, edges)
+
+
+# One tree of a forest over data, or over the worker's shared Dataset
+def growbagged(seed, scoref, maxdepth, minsamples, features, data=None):
+    data = workerdata if data is None else data
+    rng = np.random.default_rng(seed)
+    rows = rng.integers(0, len(data), len(data))
+    return growtree(data, rows, scoref, maxdepth, minsamples, features, rng)
+
+
+# A Forest of ntrees trees over rows, a list of rows or a Dataset, grown
+# across a process pool, or in this process if processes is 1. Every node
+# tries features columns, the square root of the number of columns by
+# default. The workers share the data through shared memory, or map the
+# same cache files when the data has a cache.
+def buildforest(rows, ntrees=10, scoref=entropy, features=None,
+                maxdepth=None, minsamples=2, processes=None, seed=None):
+    data = rows if isinstance(rows, Dataset) else Dataset.fromrows(rows)
+    if features is None:
+        features = max(1, int(len(data.columns) ** 0.5))
+    seeds = np.random.SeedSequence(seed).spawn(ntrees)
+    tasks = [(s, scoref, maxdepth, minsamples, features) for s in seeds]
+
+    if processes == 1:
+        return Forest([growbagged(*task, data=data) for task in tasks])
+
+    if data.cache is not None:
+        with Pool(processes, initializer=attach,
+                  initargs=(data.cache,)) as pool:
+            return Forest(pool.starmap(growbagged, tasks))
+
+    shared = SharedDataset(data)
+    try:
+        with Pool(processes, initializer=attach,
+                  initargs=(shared.spec,)) as pool:
+            return Forest(pool.starmap(growbagged, tasks))
+    finally:
+        shared.close()
 
 
 def printtree(tree, indent='  '):
@@ -193,14 +643,126 @@ def drawnode(ax, tree, x, y):
 
 
 def classify(observation, tree):
-    if tree.results is not None:
-        return tree.results
-
-    v = observation[tree.col]
-    branch = None
-    if isinstance(v, (int, float)):
-        branch = tree.tb if v >= tree.value else tree.fb
-    else:
-        branch = tree.tb if v == tree.value else tree.fb
-
-    return classify(observation, branch)
+    while tree.results is None:
+        v = observation[tree.col]
+        if isinstance(v, (int, float)):
+            tree = tree.tb if v >= tree.value else tree.fb
+        else:
+            tree = tree.tb if v == tree.value else tree.fb
+
+    return tree.results
+
+
+# A tree flattened into parallel arrays indexed by node, 0 the root: the
+# column each node tests, -1 for leaves, the threshold of numeric tests,
+# the category id of the value nominal tests compare to, the true and
+# false branches, and the results of the leaves
+class FlatTree:
+    def __init__(self, tree):
+        cols, thresholds, categories, tbs, fbs = [], [], [], [], []
+        self.results = []
+        # An id for every (col, value) a nominal test compares to
+        self.categoryids = {}
+
+        # Nodes in the order they get ids, with the parent and branch to
+        # link them to
+        stack = [(tree, None, None)]
+        while stack:
+            node, parent, branches = stack.pop()
+            n = len(cols)
+            if parent is not None:
+                branches[parent] = n
+            tbs.append(-1)
+            fbs.append(-1)
+            self.results.append(node.results)
+            if node.results is not None or node.tb is None:
+                cols.append(-1)
+                thresholds.append(np.nan)
+                categories.append(-1)
+                continue
+
+            cols.append(node.col)
+            if isinstance(node.value, (int, float)):
+                thresholds.append(node.value)
+                categories.append(-1)
+            else:
+                thresholds.append(np.nan)
+                categories.append(self.categoryids.setdefault(
+                    (node.col, node.value), len(self.categoryids)))
+            stack.append((node.fb, n, fbs))
+            stack.append((node.tb, n, tbs))
+
+        self.col = np.array(cols, dtype=np.int64)
+        self.threshold = np.array(thresholds, dtype=float)
+        self.category = np.array(categories, dtype=np.int64)
+        self.numeric = self.category < 0
+        self.tb = np.array(tbs, dtype=np.int64)
+        self.fb = np.array(fbs, dtype=np.int64)
+
+    # Every observation's values as numbers, nan where not numeric, and as
+    # category ids, -1 where the tree never compares to them, one row per
+    # observation. observations is a list of rows or a Dataset, whose
+    # binned columns read as the start of their bins, which is exact for
+    # trees grown on the same bins.
+    def encode(self, observations):
+        ncols = int(self.col.max()) + 1 if len(self.col) else 0
+        numbers = np.full((len(observations), ncols), np.nan)
+        ids = np.full((len(observations), ncols), -1, dtype=np.int64)
+        tested = self.col >= 0
+        numeric = set(self.col[tested & self.numeric].tolist())
+        nominal = set(self.col[tested & ~self.numeric].tolist())
+        for col in numeric | nominal:
+            if isinstance(observations, Dataset):
+                column = observations.columns[col]
+                if col in observations.edges:
+                    numbers[:, col] = observations.edges[col][column]
+                elif observations.isnumeric(col):
+                    numbers[:, col] = column
+                else:
+                    lookup = np.array([self.categoryids.get((col, v), -1)
+                                       for v in observations.values[col]])
+                    ids[:, col] = lookup[column]
+                continue
+
+            values = [row[col] for row in observations]
+            if col in numeric:
+                array = np.array(values)
+                if array.dtype.kind not in 'biuf':
+                    array = [v if isinstance(v, (int, float)) else np.nan
+                             for v in values]
+                numbers[:, col] = array
+            if col in nominal:
+                ids[:, col] = [self.categoryids.get((col, v), -1)
+                               for v in values]
+        return numbers, ids
+
+    # The leaf every observation reaches. All the observations still in the
+    # tree move down a level at a time with one comparison each.
+    def leaves(self, observations):
+        numbers, ids = self.encode(observations)
+        pos = np.zeros(len(numbers), dtype=np.int64)
+        live = np.flatnonzero(self.col[pos] >= 0)
+        while len(live):
+            node = pos[live]
+            col = self.col[node]
+            true = np.where(self.numeric[node],
+                            numbers[live, col] >= self.threshold[node],
+                            ids[live, col] == self.category[node])
+            pos[live] = np.where(true, self.tb[node], self.fb[node])
+            live = live[self.col[pos[live]] >= 0]
+        return pos
+
+    def predict_many(self, observations):
+        return [self.results[leaf] for leaf in self.leaves(observations)]
+
+
+def compiletree(tree):
+    return FlatTree(tree)
+
+
+# classify for many observations at once, a list of rows or a Dataset,
+# through the compiled tree
+def predict_many(observations, tree):
+    if not isinstance(tree, FlatTree):
+        tree = compiletree(tree)
+    return tree.predict_many(observations)